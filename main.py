@@ -1,16 +1,23 @@
 import tkinter as tk
-from tkinter import filedialog, ttk, scrolledtext
+from tkinter import filedialog, ttk, scrolledtext, messagebox
 import os
 import datetime
+import queue
+import threading
 
 from parreader import ParReader, ParState
-from parmanager import ParManager, ParMergeType
+from parmanager import ParManager, ParMergeType, DEFAULT_MEMORY_BUDGET
+from parcache import ParCache, DEFAULT_CACHE_DIR
+from parmanifest import latest_export
+from parcatalog import ParCatalog, FILETYPE_NAMES
+from pardecimate import get_trace_cache
+import parstats
 
 class FileLoaderApp:
     def __init__(self, root):
         
         self.files = {}
-        self.parmanager = ParManager()
+        self.parmanager = ParManager(cache=ParCache(), memory_budget=DEFAULT_MEMORY_BUDGET)
         
         self.root = root
         self.root.title("File Loader GUI")
@@ -34,17 +41,31 @@ class FileLoaderApp:
         self.scrollbar.pack(side="right", fill="y")
 
         # 파일 열기 버튼
-        open_button = tk.Button(root, text="Open Files", command=self.open_file)
-        open_button.pack(padx=10, pady=10)
+        self.open_button = tk.Button(root, text="Open Files", command=self.open_file)
+        self.open_button.pack(padx=10, pady=10)
         
-        save_button = tk.Button(root, text="Save", command=self.save)
-        save_button.pack(padx=10, pady=10)
+        # 폴더 전체를 카탈로그로 훑어보고 고른 파일만 읽는다
+        self.folder_button = tk.Button(root, text="Open Folder", command=self.open_folder)
+        self.folder_button.pack(padx=10)
+        
+        self.save_button = tk.Button(root, text="Save", command=self.save)
+        self.save_button.pack(padx=10, pady=10)
         
         self.check = [tk.IntVar()]
         
         checkbox1 = tk.Checkbutton(root, text="Detail", variable=self.check[0])
         checkbox1.pack(padx=10, pady=10)
         
+        # 이전 저장 결과에서 바뀌지 않은 출력은 다시 만들지 않는다
+        self.incremental = tk.IntVar(value=1)
+        incremental_checkbox = tk.Checkbutton(root, text="Incremental", variable=self.incremental)
+        incremental_checkbox.pack(padx=10)
+        
+        # 단계별 시간 / 메모리 측정
+        self.profile = tk.IntVar()
+        profile_checkbox = tk.Checkbutton(root, text="Profile", variable=self.profile)
+        profile_checkbox.pack(padx=10)
+        
         self.mode = tk.IntVar()
         
         default_rad = tk.Radiobutton(root, text="Default", variable=self.mode, value=0)
@@ -54,21 +75,232 @@ class FileLoaderApp:
         default_rad.pack()
         PBS_rad.pack()
         Tafel_rad.pack()
+        
+        # 백그라운드 작업 진행 상태
+        self.status = tk.StringVar(value="Ready")
+        status_label = tk.Label(root, textvariable=self.status)
+        status_label.pack(padx=10)
+        
+        self.progress = ttk.Progressbar(root, orient="horizontal", length=150, mode="determinate")
+        self.progress.pack(padx=10, pady=5)
+        
+        self.cancel_button = tk.Button(root, text="Cancel", command=self.cancel_job, state="disabled")
+        self.cancel_button.pack(padx=10, pady=5)
+        
+        # 선택한 세그먼트 미리보기, 처음 쓸 때 만든다
+        self.preview_frame = tk.Frame(root)
+        self.preview_frame.pack(side="bottom", fill="both", expand=True)
+        self.preview = None
+        
+        # worker threads only talk to the Tk thread through this queue
+        self.jobs = queue.Queue()
+        self.job = None
+        self.cancel = threading.Event()
+        self.savepath = None
+        self.catalog = None
+        # 파일별 Delete / Segment 위젯, 작업 중에는 잠근다
+        self.file_widgets = {}
     
     def save(self):
 
         savepath = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
         os.makedirs(savepath, exist_ok=True)
-        self.parmanager.save(savepath, self.check, self.mode)
+        detail = self.check[0].get()
+        mode = self.mode.get()
+        previous = None
+        if self.incremental.get():
+            previous = self.savepath or latest_export(".")
+        self.savepath = savepath
+        self.start_job("Saving", self.save_job, savepath, detail, mode, previous)
+    
+    def save_job(self, savepath, detail, mode, previous):
+        self.parmanager.save(savepath, detail, mode, progress=self.report_progress, cancel=self.cancel, previous=previous)
 
     def open_file(self):
         filepaths = filedialog.askopenfilenames(title="Select files")
-        for filepath in filepaths:
-            par = ParReader(filepath)
-            self.parmanager.add(par)
-        self.parmanager.sort()
+        if len(filepaths) == 0:
+            return
+        self.start_job("Loading", self.load_job, list(filepaths))
+    
+    def open_folder(self):
+        directory = filedialog.askdirectory(title="Select folder")
+        if not directory:
+            return
+        self.start_job("Scanning", self.scan_job, directory)
+    
+    def scan_job(self, directory):
+        catalog = ParCatalog(directory, DEFAULT_CACHE_DIR)
+        catalog.update(progress=self.report_progress, cancel=self.cancel)
+        catalog.save()
+        self.jobs.put(("catalog", catalog))
+    
+    def show_catalog(self, catalog):
+        # 이름 / 종류 / 세그먼트 수로 거르고, 선택한 파일만 (없으면 보이는 전부) 불러온다
+        window = tk.Toplevel(self.root)
+        window.title(catalog.root)
+        
+        filters = tk.Frame(window)
+        filters.pack(fill="x", padx=5, pady=5)
+        tk.Label(filters, text="Name").pack(side="left")
+        pattern = tk.StringVar()
+        tk.Entry(filters, textvariable=pattern, width=15).pack(side="left", padx=5)
+        filetype = ttk.Combobox(filters, values=["all", *FILETYPE_NAMES.values()], state="readonly", width=8)
+        filetype.set("all")
+        filetype.pack(side="left", padx=5)
+        tk.Label(filters, text="Min segments").pack(side="left")
+        min_segments = tk.Spinbox(filters, from_=0, to=1000, width=5)
+        min_segments.pack(side="left", padx=5)
+        
+        listbox = tk.Listbox(window, selectmode="extended", width=70, height=20, font=("Courier", 9))
+        listbox.pack(fill="both", expand=True, padx=5)
+        count = tk.Label(window)
+        count.pack()
+        shown = []
+        
+        def refresh(*args):
+            try:
+                segments = int(min_segments.get())
+            except ValueError:
+                segments = None
+            filetypes = None if filetype.get() == "all" else {key for key, name in FILETYPE_NAMES.items() if name == filetype.get()}
+            shown[:] = catalog.select(filetypes, f"*{pattern.get()}*", segments)
+            listbox.delete(0, "end")
+            for entry in shown:
+                listbox.insert("end", f"{entry['filename']:<24}{FILETYPE_NAMES[entry['filetype']]:<10}{entry['segments']:>4} seg {entry['rows']:>9} rows")
+            count.configure(text=f"{len(shown)} / {len(catalog.entries)} files")
+        
+        def load():
+            selection = listbox.curselection() or range(len(shown))
+            filepaths = [shown[i]["filepath"] for i in selection]
+            if len(filepaths) == 0 or self.job is not None:
+                return
+            window.destroy()
+            self.start_job("Loading", self.load_job, filepaths)
+        
+        pattern.trace_add("write", refresh)
+        filetype.bind('<<ComboboxSelected>>', refresh)
+        min_segments.configure(command=refresh)
+        min_segments.bind('<KeyRelease>', refresh)
+        tk.Button(window, text="Load", command=load).pack(pady=5)
+        refresh()
+    
+    def load_job(self, filepaths):
+        loader = self.parmanager.iter_load(filepaths)
+        try:
+            for done, par in enumerate(loader, 1):
+                self.jobs.put(("loaded", par))
+                self.report_progress(done, len(filepaths))
+                if self.cancel.is_set():
+                    break
+        finally:
+            loader.close()
+    
+    def start_job(self, name, target, *args):
+        if self.job is not None:
+            return
+        self.cancel.clear()
+        self.job = name
+        self.open_button.configure(state="disabled")
+        self.folder_button.configure(state="disabled")
+        self.save_button.configure(state="disabled")
+        self.cancel_button.configure(state="normal")
+        self.lock_file_groups(True)
+        self.status.set(f"{name}...")
+        self.progress["value"] = 0
+        if self.profile.get():
+            parstats.enable()
+        
+        def run():
+            try:
+                target(*args)
+                self.jobs.put(("done", None))
+            except Exception as e:
+                self.jobs.put(("done", e))
+        
+        threading.Thread(target=run, daemon=True).start()
+        self.root.after(50, self.poll_jobs)
+    
+    def report_progress(self, done, total):
+        self.jobs.put(("progress", (done, total)))
+    
+    def cancel_job(self):
+        self.cancel.set()
+        self.status.set(f"{self.job} : cancelling...")
+    
+    def poll_jobs(self):
+        while True:
+            try:
+                kind, value = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            
+            if kind == "loaded":
+                if value.status == ParState.OK:
+                    self.parmanager.add(value)
+                    self.add_file_group(value)
+            elif kind == "preview":
+                self.draw_preview(*value)
+            elif kind == "catalog":
+                self.catalog = value
+            elif kind == "progress":
+                done, total = value
+                self.progress["maximum"] = total
+                self.progress["value"] = done
+                self.status.set(f"{self.job} {done} / {total}")
+            elif kind == "done":
+                self.finish_job(value)
+                return
+        
+        self.root.after(50, self.poll_jobs)
+    
+    def finish_job(self, error):
+        name = self.job
+        self.job = None
+        self.open_button.configure(state="normal")
+        self.folder_button.configure(state="normal")
+        self.save_button.configure(state="normal")
+        self.cancel_button.configure(state="disabled")
+        self.lock_file_groups(False)
+        
+        if name == "Loading":
+            self.parmanager.finish_load()
+            self.refresh_file_groups()
+        
+        stats = parstats.disable()
+        if error is not None:
+            self.status.set(f"{name} failed")
+            messagebox.showerror(name, str(error))
+        elif self.cancel.is_set():
+            self.status.set(f"{name} cancelled")
+        else:
+            self.status.set(f"{name} done")
+            if stats is not None and name == "Saving":
+                self.show_stats(stats, self.savepath)
+        if name == "Scanning" and error is None and self.catalog is not None:
+            self.show_catalog(self.catalog)
+    
+    def show_stats(self, stats, savepath):
+        # stats.json (records, per file and per stage totals) and trace.json (chrome://tracing) next to the outputs
+        stats.save_json(os.path.join(savepath, "stats.json"))
+        stats.save_chrome_trace(os.path.join(savepath, "trace.json"))
+        
+        window = tk.Toplevel(self.root)
+        window.title("Profile")
+        text = scrolledtext.ScrolledText(window, width=90, height=20, font=("Courier", 9))
+        text.insert("1.0", f"{stats.report()}\n\nsaved to {savepath}/stats.json, {savepath}/trace.json")
+        text.configure(state="disabled")
+        text.pack(fill="both", expand=True)
+    
+    def lock_file_groups(self, locked, widgets=None):
+        # the save thread iterates the files and reads their selected segments
+        for delete_button, options_combobox in widgets or self.file_widgets.values():
+            delete_button.configure(state="disabled" if locked else "normal")
+            options_combobox.configure(state="disabled" if locked else "readonly")
+    
+    def refresh_file_groups(self):
         for widget in self.scrollable_frame.winfo_children():
             widget.destroy()
+        self.file_widgets.clear()
         for par in self.parmanager.files.values():
             self.add_file_group(par)
             
@@ -86,6 +318,7 @@ class FileLoaderApp:
         delete_button.pack(side="left", padx=5)
 
         filename_label = tk.Label(frame, text=f"Filename: {filename}", bg='white')
+        filename_label.bind('<Button-1>', lambda event : self.show_preview(par))
         filename_label.pack(side="left", padx=5)
 
         values = [f"Segment#{_}" for _ in range(par.max_segment)] if par.status == ParState.OK else ["Empty Data"]
@@ -93,15 +326,59 @@ class FileLoaderApp:
         options_combobox.set("Segment#2")  # default value
         options_combobox.bind('<<ComboboxSelected>>', lambda event : self.changed(event, par))
         options_combobox.pack(side="left", padx=5)
+        
+        self.file_widgets[frame] = (delete_button, options_combobox)
+        if self.job is not None:
+            self.lock_file_groups(True, [self.file_widgets[frame]])
     
     def changed(self, event, par):
         selected_value = event.widget.get()
         par.select_segment = int(selected_value.split("#")[-1])
+        self.show_preview(par)
+    
+    def show_preview(self, par):
+        # decimated trace of the selected segment with its peaks. A trace cache miss reloads and decimates the file,
+        # so it runs as a background job ; none while another job uses the files
+        if self.job is not None or par.status != ParState.OK or par.select_segment >= par.max_segment:
+            return
+        self.start_job("Preview", self.preview_job, par)
+    
+    def preview_job(self, par):
+        segment = par.select_segment
+        voltages, currents = get_trace_cache().trace(par, segment)
+        firstPeak, secondPeak = par.peaksAll[segment]
+        self.parmanager.release(par)
+        self.jobs.put(("preview", (par.filename, segment, voltages, currents, firstPeak, secondPeak)))
+    
+    def draw_preview(self, filename, segment, voltages, currents, firstPeak, secondPeak):
+        # matplotlib is only imported for the first preview
+        if self.preview is None:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            figure = Figure(figsize=(5, 3), dpi=100)
+            self.preview_axes = figure.add_subplot()
+            self.preview = FigureCanvasTkAgg(figure, master=self.preview_frame)
+            self.preview.get_tk_widget().pack(fill="both", expand=True)
+            self.root.geometry("600x750")
+        
+        axes = self.preview_axes
+        axes.clear()
+        axes.set_title(f"{filename}, Segment # {segment}", fontsize=9)
+        axes.plot(voltages, currents)
+        if firstPeak[0] != -1:
+            axes.scatter(firstPeak[1], firstPeak[2], s=30, color='b')
+        if secondPeak[0] != -1:
+            axes.scatter(secondPeak[1], secondPeak[2], s=30, color='r')
+        self.preview.draw_idle()
 
     def delete_file_group(self, par, frame):
+        if self.job is not None:
+            return
+        self.file_widgets.pop(frame, None)
         frame.destroy()
         self.parmanager.remove(par.filepath)
 
-root = tk.Tk()
-app = FileLoaderApp(root)
-root.mainloop()
+if __name__ == "__main__":
+    root = tk.Tk()
+    app = FileLoaderApp(root)
+    root.mainloop()
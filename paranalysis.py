@@ -0,0 +1,198 @@
+from collections import namedtuple
+
+import numpy as np
+
+NOPEAK = (-1, -1, -1)
+PEAK_WIDTH = 10
+
+# log10 |I (mA)| = slope * E + intercept over voltageData[start:stop], r2 : linearity of the fit,
+# estart / estop : voltages of the first and last sample of the window
+TafelLine = namedtuple("TafelLine", "start stop slope intercept r2 estart estop")
+# ecorr (V) / icorr (A) : intersection of the cathodic and anodic lines
+TafelFit = namedtuple("TafelFit", "cathodic anodic ecorr icorr")
+NOTAFEL = TafelLine(-1, -1, np.nan, np.nan, np.nan, np.nan, np.nan)
+
+TAFEL_MIN_POINTS = 10
+# window lengths tried grow by this ratio, the longest one within the tolerance of the best r2 wins
+TAFEL_LENGTH_RATIO = 1.1
+TAFEL_R2_TOLERANCE = 0.005
+
+def segmented_argmax(data, starts, stops):
+    return _segmented_arg(np.maximum, data, starts, stops)
+
+def segmented_argmin(data, starts, stops):
+    return _segmented_arg(np.minimum, data, starts, stops)
+
+def _segmented_arg(ufunc, data, starts, stops):
+    # Absolute index of the first extreme of every data[starts[i]:stops[i]], starts[i] when empty
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    result = starts.copy()
+
+    nonempty = np.flatnonzero(stops > starts)
+    if len(nonempty) == 0:
+        return result
+
+    # reduceat wants ascending bounds, ranges never overlap so sorting by start is enough
+    nonempty = nonempty[np.argsort(starts[nonempty], kind='stable')]
+    rangeStarts = starts[nonempty]
+    rangeLengths = stops[nonempty] - rangeStarts
+
+    # reduceat over [s0, e0, s1, e1, ...], even slots hold the reduction of each range
+    bounds = np.empty(2 * len(rangeStarts), dtype=np.int64)
+    bounds[0::2] = rangeStarts
+    bounds[1::2] = rangeStarts + rangeLengths
+    if bounds[-1] == len(data):
+        bounds = bounds[:-1]
+    extremes = ufunc.reduceat(data, bounds)[0::2]
+
+    # first position in each range holding its extreme
+    labels, positions = range_positions(rangeStarts, rangeLengths)
+
+    values = data[positions]
+    targets = extremes[labels]
+    hits = values == targets
+    if np.isnan(extremes).any():
+        # like np.argmax, a NaN is the extreme of its range
+        hits |= np.isnan(values) & np.isnan(targets)
+
+    hitIdx = np.flatnonzero(hits)
+    _, firstHit = np.unique(labels[hitIdx], return_index=True)
+    result[nonempty] = positions[hitIdx[firstHit]]
+    return result
+
+def range_positions(starts, lengths):
+    # (range label, absolute index) of every element of the ranges, in range order
+    labels = np.repeat(np.arange(len(starts)), lengths)
+    firstPos = np.cumsum(lengths) - lengths
+    positions = np.arange(len(labels)) + np.repeat(starts - firstPos, lengths)
+    return labels, positions
+
+def split_halves(voltageData, starts, stops):
+    # First half : [max, min) when the sweep starts going down, else [start, min)
+    # Second half : [min, stop) or [min, max)
+    voltageMaxIdx = segmented_argmax(voltageData, starts, stops)
+    voltageMinIdx = segmented_argmin(voltageData, starts, stops)
+    maxFirst = voltageMaxIdx < voltageMinIdx
+
+    firstHalfRanges = np.empty((len(starts), 2), dtype=np.int64)
+    firstHalfRanges[:, 0] = np.where(maxFirst, voltageMaxIdx, starts)
+    firstHalfRanges[:, 1] = voltageMinIdx
+
+    secondHalfRanges = np.empty((len(starts), 2), dtype=np.int64)
+    secondHalfRanges[:, 0] = voltageMinIdx
+    secondHalfRanges[:, 1] = np.where(maxFirst, stops, voltageMaxIdx)
+    return firstHalfRanges, secondHalfRanges
+
+def log_scale_currents(currentData):
+    with np.errstate(divide='ignore'):
+        return np.log10(np.abs(currentData * (10**3)))
+
+def split_tafel(logScaleCurrentData, secondHalfRanges):
+    # Cathodic : second half up to the min log current, anodic : from there up to the max
+    starts = secondHalfRanges[:, 0]
+    stops = secondHalfRanges[:, 1]
+    tafelMinCurrentIdx = segmented_argmin(logScaleCurrentData, starts, stops)
+    tafelMaxCurrentIdx = segmented_argmax(logScaleCurrentData, starts, stops)
+
+    cathodicRanges = np.empty((len(starts), 2), dtype=np.int64)
+    cathodicRanges[:, 0] = starts
+    cathodicRanges[:, 1] = tafelMinCurrentIdx
+
+    anodicRanges = np.empty((len(starts), 2), dtype=np.int64)
+    anodicRanges[:, 0] = tafelMinCurrentIdx
+    anodicRanges[:, 1] = np.maximum(tafelMinCurrentIdx, tafelMaxCurrentIdx)
+    return cathodicRanges, anodicRanges
+
+def tafel_lengths(minPoints, n, ratio=TAFEL_LENGTH_RATIO):
+    lengths = np.unique(np.round(minPoints * ratio ** np.arange(np.log(n / minPoints) / np.log(ratio) + 1)).astype(np.int64))
+    return np.union1d(lengths[lengths <= n], [n])
+
+def fit_tafel_line(voltageData, logScaleCurrentData, branchRange, minPoints=TAFEL_MIN_POINTS):
+    # Most linear window of one Tafel branch. Window sums come from prefix sums, so every offset of one
+    # window length costs O(n) ; lengths follow a geometric ladder, O(n log n) for the branch.
+    start, stop = int(branchRange[0]), int(branchRange[1])
+    n = stop - start
+    if n < minPoints:
+        return NOTAFEL
+
+    voltages = voltageData[start:stop]
+    logCurrents = logScaleCurrentData[start:stop]
+    finite = np.isfinite(logCurrents)
+    if not finite.any():
+        return NOTAFEL
+
+    # centered, so the sums of squares do not cancel
+    meanX = voltages.mean()
+    meanY = logCurrents[finite].mean()
+    x = voltages - meanX
+    y = np.where(finite, logCurrents - meanY, 0.0)
+    sums = np.zeros((6, n + 1))
+    np.cumsum([x, y, x * x, x * y, y * y, ~finite], axis=1, out=sums[:, 1:])
+
+    candidates = []
+    for length in tafel_lengths(minPoints, n):
+        sx, sy, sxx, sxy, syy, bad = sums[:, length:] - sums[:, :-length]
+        dx = length * sxx - sx * sx
+        dy = length * syy - sy * sy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r2 = (length * sxy - sx * sy) ** 2 / (dx * dy)
+        r2[(bad > 0.5) | ~(dx > 0) | ~(dy > 0)] = -np.inf
+        offset = int(np.argmax(r2))
+        if np.isfinite(r2[offset]):
+            candidates.append((float(r2[offset]), int(length), offset))
+    if len(candidates) == 0:
+        return NOTAFEL
+
+    bestR2 = max(candidate[0] for candidate in candidates)
+    r2, length, offset = max(candidates, key=lambda candidate: (candidate[0] >= bestR2 - TAFEL_R2_TOLERANCE, candidate[1]))
+    sx, sy, sxx, sxy, _, _ = sums[:, offset + length] - sums[:, offset]
+    slope = (length * sxy - sx * sy) / (length * sxx - sx * sx)
+    intercept = meanY + sy / length - slope * (meanX + sx / length)
+    return TafelLine(start + offset, start + offset + length, float(slope), float(intercept), r2,
+                     float(voltages[offset]), float(voltages[offset + length - 1]))
+
+def fit_segment_tafel(voltageData, logScaleCurrentData, cathodicRange, anodicRange):
+    cathodic = fit_tafel_line(voltageData, logScaleCurrentData, cathodicRange)
+    anodic = fit_tafel_line(voltageData, logScaleCurrentData, anodicRange)
+    if cathodic.slope == anodic.slope or np.isnan(cathodic.slope) or np.isnan(anodic.slope):
+        return TafelFit(cathodic, anodic, np.nan, np.nan)
+    ecorr = (cathodic.intercept - anodic.intercept) / (anodic.slope - cathodic.slope)
+    # log currents are of mA
+    icorr = 10 ** (anodic.slope * ecorr + anodic.intercept) / 10**3
+    return TafelFit(cathodic, anodic, float(ecorr), float(icorr))
+
+def find_half_peak(voltages, currents, sign):
+    # First peak of sign * current (cathodic : -1, anodic : +1)
+    if len(currents) == 0:
+        return NOPEAK
+    from scipy.signal import find_peaks
+    peaks, _ = find_peaks(sign * np.float32(currents), width=PEAK_WIDTH)
+    if len(peaks) == 0:
+        return NOPEAK
+    return (int(peaks[0]), float(voltages[peaks[0]]), float(currents[peaks[0]]))
+
+def find_segment_peaks(voltageData, currentData, firstHalfRange, secondHalfRange):
+    firstStart, firstEnd = firstHalfRange
+    secondStart, secondEnd = secondHalfRange
+    return [
+        find_half_peak(voltageData[firstStart:firstEnd], currentData[firstStart:firstEnd], -1),
+        find_half_peak(voltageData[secondStart:secondEnd], currentData[secondStart:secondEnd], 1),
+    ]
+
+def encode_peaks(peaksAll):
+    # list of [first, second] peak tuples (None : not computed yet) -> (segments, 2, 3) float array
+    encoded = np.full((len(peaksAll), 2, 3), np.nan)
+    for segment, peaks in enumerate(peaksAll):
+        if peaks is not None:
+            encoded[segment] = peaks
+    return encoded
+
+def decode_peaks(encoded):
+    peaksAll = []
+    for peaks in encoded:
+        if np.isnan(peaks[0, 0]):
+            peaksAll.append(None)
+        else:
+            peaksAll.append([NOPEAK if peak[0] == -1 else (int(peak[0]), float(peak[1]), float(peak[2])) for peak in peaks])
+    return peaksAll
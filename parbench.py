@@ -0,0 +1,242 @@
+import os
+import sys
+import math
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+from parreader import ParReader
+from parmanager import ParManager
+from parrender import get_renderer
+from pargen import write_par, write_campaign
+
+# (name, segments, rows per segment)
+SIZES = [
+    ("small", 4, 1000),
+    ("medium", 8, 10000),
+    ("large", 10, 50000),
+]
+CAMPAIGN_FILES = 8
+DEFAULT_BASELINE = "parbench_baseline.json"
+
+# seconds a fresh interpreter may spend importing each entry point : parse core, headless cli, GUI
+IMPORT_BUDGETS = {
+    "parreader": 0.3,
+    "parcli": 0.4,
+    "main": 0.5,
+}
+# modules the entry points must not import until plotting / csv export / peak detection runs
+HEAVY_MODULES = ("matplotlib", "pandas", "scipy", "pyarrow")
+
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start, [name for name in {heavy!r} if name in sys.modules]]))
+"""
+
+def best_of(repeat, setup, run):
+    # minimum wall time of run(setup()) over repeat runs, setup is not timed ;
+    # an untimed first run pays the lazy imports
+    run(setup())
+    best = None
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench_imports(repeat):
+    # best import time of every entry point in a fresh interpreter, and the heavy modules it pulled in
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in IMPORT_BUDGETS:
+        best = None
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                    cwd=here, capture_output=True, text=True, check=True).stdout
+            seconds, heavy = json.loads(output.splitlines()[-1])
+            best = seconds if best is None else min(best, seconds)
+        results[module] = (best, heavy)
+    return results
+
+def check_imports(imports):
+    # entry points over their budget or importing heavy modules
+    failures = []
+    print(f"{'import':<22}{'time (ms)':>12}{'budget':>12}")
+    for module, (seconds, heavy) in imports.items():
+        line = f"{module:<22}{seconds * 1e3:>12.2f}{IMPORT_BUDGETS[module] * 1e3:>12.2f}"
+        if seconds > IMPORT_BUDGETS[module]:
+            line += "  OVER BUDGET"
+            failures.append(module)
+        if heavy:
+            line += f"  imports {', '.join(heavy)}"
+            failures.append(module)
+        print(line)
+    return failures
+
+def bench_file(filepath, repeat):
+    def parsed():
+        par = ParReader.__new__(ParReader)
+        par.cache = None
+        par.read_data(filepath)
+        par.invalidate()
+        return par
+
+    def analysed():
+        par = parsed()
+        par.update_analysis()
+        return par
+
+    return {
+        "parse": best_of(repeat, lambda: None, lambda _: parsed()),
+        "analysis": best_of(repeat, parsed, lambda par: par.update_analysis()),
+        "peaks": best_of(repeat, analysed, lambda par: par.analysis_all()),
+    }
+
+def reference_analysis(voltages, currents):
+    # the per segment list analysis the vectorized one replaced :
+    # (first half, second half, cathodic, anodic) as (voltages, currents or log currents), and the peaks
+    from scipy.signal import find_peaks
+    voltages, currents = list(voltages), list(currents)
+    voltageMaxIdx = voltages.index(max(voltages))
+    voltageMinIdx = voltages.index(min(voltages))
+    if voltageMaxIdx < voltageMinIdx:
+        first = (voltages[voltageMaxIdx:voltageMinIdx], currents[voltageMaxIdx:voltageMinIdx])
+        second = (voltages[voltageMinIdx:], currents[voltageMinIdx:])
+    else:
+        first = (voltages[:voltageMinIdx], currents[:voltageMinIdx])
+        second = (voltages[voltageMinIdx:voltageMaxIdx], currents[voltageMinIdx:voltageMaxIdx])
+
+    peaks = []
+    for (halfVoltages, halfCurrents), sign in ((first, -1), (second, 1)):
+        found = find_peaks(sign * np.float32(halfCurrents), width=10)[0] if halfCurrents else []
+        peaks.append((-1, -1, -1) if len(found) == 0 else (int(found[0]), halfVoltages[found[0]], halfCurrents[found[0]]))
+
+    if not second[1]:
+        return [first, second, ([], []), ([], [])], peaks
+    logCurrents = [math.log10(abs(current * (10**3))) for current in second[1]]
+    tafelMinCurrentIdx = logCurrents.index(min(logCurrents))
+    tafelMaxCurrentIdx = logCurrents.index(max(logCurrents))
+    cathodic = (second[0][:tafelMinCurrentIdx], logCurrents[:tafelMinCurrentIdx])
+    anodic = (second[0][tafelMinCurrentIdx:tafelMaxCurrentIdx], logCurrents[tafelMinCurrentIdx:tafelMaxCurrentIdx])
+    return [first, second, cathodic, anodic], peaks
+
+def check_analysis(filepath):
+    # segments whose halves, Tafel branches or peaks differ from reference_analysis ;
+    # voltages, currents and peaks must be identical, log currents within a few ulp
+    par = ParReader(filepath)
+    parts = [
+        (par.firstHalfVoltagesAll, par.firstHalfCurrentsAll),
+        (par.secondHalfVoltagesAll, par.secondHalfCurrentsAll),
+        (par.cathodicVoltagesAll, par.cathodicCurrentsAll),
+        (par.anodicVoltagesAll, par.anodicCurrentsAll),
+    ]
+    mismatches = []
+    for segment in range(par.max_segment):
+        expected, peaks = reference_analysis(par.voltages[segment], par.currents[segment])
+        same = peaks == par.peaksAll[segment]
+        for i, (voltages, currents) in enumerate(parts):
+            same = same and np.array_equal(voltages[segment], expected[i][0])
+            if i < 2:
+                same = same and np.array_equal(currents[segment], expected[i][1])
+            else:
+                same = same and len(currents[segment]) == len(expected[i][1]) and np.allclose(currents[segment], expected[i][1], rtol=4 * np.finfo(float).eps, atol=0)
+        if not same:
+            mismatches.append(segment)
+    return mismatches
+
+def bench_export(filepaths, savepath, repeat):
+    def manager():
+        par_manager = ParManager(workers=1)
+        par_manager.load(filepaths)
+        return par_manager
+
+    single = ParReader(filepaths[0])
+    single.analysis_all()
+    return {
+        "csv_export": best_of(repeat, manager, lambda m: (m.save_user_figure(savepath), m.save_user_csv(savepath))),
+        "render": best_of(repeat, lambda: single, lambda par: get_renderer().render_file(par, savepath)),
+    }
+
+def run(sizes, repeat, workdir):
+    # timings, and the sizes whose analysis differs from the reference
+    results = {}
+    failures = []
+    for name, segments, rows in sizes:
+        sizedir = os.path.join(workdir, name)
+        filepath = os.path.join(sizedir, "single.par")
+        os.makedirs(sizedir, exist_ok=True)
+        write_par(filepath, segments, rows)
+        filepaths = write_campaign(os.path.join(sizedir, "campaign"), CAMPAIGN_FILES, segments, rows)
+        savepath = os.path.join(sizedir, "out")
+        os.makedirs(savepath, exist_ok=True)
+
+        mismatches = check_analysis(filepath)
+        if mismatches:
+            failures.append(f"{name} (segments {mismatches})")
+        timings = bench_file(filepath, repeat)
+        timings.update(bench_export(filepaths, savepath, max(1, repeat // 2)))
+        for stage, seconds in timings.items():
+            results[f"{stage}/{name}"] = seconds
+    return results, failures
+
+def report(results, baseline, threshold):
+    # prints every stage against the baseline, returns the regressed stages
+    regressions = []
+    print(f"{'stage':<22}{'time (ms)':>12}{'baseline':>12}{'ratio':>8}")
+    for key, seconds in results.items():
+        line = f"{key:<22}{seconds * 1e3:>12.2f}"
+        if key in baseline:
+            ratio = seconds / baseline[key]
+            line += f"{baseline[key] * 1e3:>12.2f}{ratio:>8.2f}"
+            if ratio > threshold:
+                line += "  REGRESSION"
+                regressions.append(key)
+        print(line)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark parse, analysis, peaks, csv export and figure rendering, and check the analysis against the per segment reference")
+    parser.add_argument("--sizes", nargs="*", choices=[size[0] for size in SIZES], default=[size[0] for size in SIZES],
+                        help="data sizes to run, none for the import checks only")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per stage, the best one counts")
+    parser.add_argument("-b", "--baseline", default=DEFAULT_BASELINE, help="baseline json to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("-t", "--threshold", type=float, default=1.25, help="slowdown ratio reported as a regression")
+    args = parser.parse_args(argv)
+
+    imports = bench_imports(args.repeat)
+    workdir = tempfile.mkdtemp(prefix="parbench_")
+    try:
+        results, mismatches = run([size for size in SIZES if size[0] in args.sizes], args.repeat, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.threshold)
+    print()
+    failures = check_imports(imports)
+    for mismatch in mismatches:
+        print(f"analysis differs from the reference : {mismatch}")
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    return 1 if regressions or failures or mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from parreader import ParReader, ParState
+from partags import ParTagIndex
+from paranalysis import encode_peaks
+from parstats import timed
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".parcache")
+DEFAULT_CACHE_SIZE = 1 << 30
+
+ARRAY_FIELDS = ("voltageData", "currentData", "segmentOffsets")
+META_FIELDS = ("filepath", "filename", "filetype", "status", "max_segment", "select_segment")
+
+def file_hash(filepath):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ParCache:
+    # Parsed arrays and peaks of .par files as .npz entries, one per source path.
+    # Entries are checked against the source size, mtime and content hash, and the least
+    # recently used ones are removed once the directory grows over max_bytes.
+    def __init__(self, cachedir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        os.makedirs(cachedir, exist_ok=True)
+
+    def entry_path(self, filepath):
+        key = hashlib.sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()
+        return os.path.join(self.cachedir, f"{key}.npz")
+
+    @timed("cache_load", lambda self, filepath: (os.path.basename(filepath), None))
+    def load(self, filepath):
+        entrypath = self.entry_path(filepath)
+        try:
+            stat = os.stat(filepath)
+            entry = np.load(entrypath, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+        with entry:
+            meta = json.loads(str(entry["meta"]))
+            if meta["version"] != CACHE_VERSION or meta["size"] != stat.st_size:
+                self.remove(filepath)
+                return None
+            if meta["mtime"] != stat.st_mtime_ns and meta["hash"] != file_hash(filepath):
+                self.remove(filepath)
+                return None
+
+            state = {field: meta[field] for field in META_FIELDS}
+            state["filepath"] = filepath
+            state["cache"] = self
+            state["_voltageData"] = entry["voltageData"]
+            state["_currentData"] = entry["currentData"]
+            state["segmentOffsets"] = entry["segmentOffsets"]
+            state["_peaks"] = entry["_peaks"]
+            state["content"] = ParTagIndex(filepath, offsets={name: tuple(offset) for name, offset in meta["tags"].items()})
+
+        par = ParReader.__new__(ParReader)
+        par.__setstate__(state)
+
+        # touched entries are the most recently used
+        if meta["mtime"] != stat.st_mtime_ns:
+            self.store(par)
+        else:
+            os.utime(entrypath)
+        return par
+
+    @timed("cache_store", lambda self, par: (par.filename, par.row_count()))
+    def store(self, par):
+        if par.status != ParState.OK:
+            return
+
+        # peaks found so far, the others stay None in the entry
+        stat = os.stat(par.filepath)
+        meta = {field: getattr(par, field) for field in META_FIELDS}
+        meta.update({
+            "version": CACHE_VERSION,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": file_hash(par.filepath),
+            "tags": par.content.offsets,
+        })
+        arrays = {field: getattr(par, field) for field in ARRAY_FIELDS}
+        arrays["_peaks"] = encode_peaks(par._peaks)
+
+        # write then rename, so readers never see a half written entry
+        entrypath = self.entry_path(par.filepath)
+        temppath = f"{entrypath[:-4]}.{os.getpid()}.tmp.npz"
+        np.savez(temppath, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(temppath, entrypath)
+
+    def remove(self, filepath):
+        try:
+            os.remove(self.entry_path(filepath))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.cachedir):
+            if entry.name.endswith(".npz") and ".tmp." not in entry.name:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        # drop least recently used entries until the cache fits in max_bytes
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entrypath in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entrypath)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, entrypath in self.entries():
+            os.remove(entrypath)
@@ -0,0 +1,178 @@
+import os
+import json
+import fnmatch
+import hashlib
+
+from parreader import ParState, ParFileNameType, file_type, file_order
+from partags import ParTagIndex
+from parstats import timed
+
+CATALOG_VERSION = 1
+# tags larger than this are data blocks, not header values
+HEADER_TAG_SIZE = 1 << 16
+SEGMENT_HEADER_LINES = 4
+
+FILETYPE_NAMES = {
+    ParFileNameType.NONE: "none",
+    ParFileNameType.PBS: "pbs",
+    ParFileNameType.GLUCOSE: "glucose",
+    ParFileNameType.VOLTAGE: "voltage",
+}
+
+def walk_files(root):
+    # (absolute path, stat) of every .par file under root
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_files(entry.path)
+        elif entry.name.lower().endswith(".par") and entry.is_file():
+            yield os.path.abspath(entry.path), entry.stat()
+
+def header_values(name, text):
+    # Key=Value lines of a header tag as "Tag.Key" -> value, the whole body when it has none
+    values = {}
+    for line in text.split("\n"):
+        key, sep, value = line.partition("=")
+        if sep:
+            values[f"{name}.{key.strip()}"] = value.strip()
+    return values or {name: text}
+
+def segment_structure(content):
+    # (header values, rows, segments) of the Segment1 block without parsing it : rows from the line count,
+    # segments from the segment number of the last row. Rows the reader skips by status are counted.
+    start, end = content.offsets["Segment1"]
+    values = {}
+    with open(content.filepath, 'rb') as f:
+        f.seek(start)
+        for _ in range(SEGMENT_HEADER_LINES):
+            if f.tell() >= end:
+                break
+            values.update(header_values("Segment1", f.readline().decode(content.encoding, errors="replace").strip()))
+        values.pop("Segment1", None)
+        first = pos = f.tell()
+        if pos >= end:
+            return values, 0, 0
+
+        rows = 1
+        while pos < end:
+            chunk = f.read(min(1 << 20, end - pos))
+            if len(chunk) == 0:
+                break
+            rows += chunk.count(b"\n")
+            pos += len(chunk)
+        f.seek(max(end - 4096, first))
+        last = f.read(end - f.tell()).rsplit(b"\n", 1)[-1]
+    try:
+        segments = int(float(last.split(b",", 1)[0])) + 1
+    except ValueError:
+        segments = 0
+    return values, rows, segments
+
+@timed("catalog_scan", lambda filepath, stat=None: (os.path.basename(filepath), None))
+def scan_file(filepath, stat=None):
+    # catalog entry of one file from its tag offsets, header tags and Segment1 line structure
+    stat = stat or os.stat(filepath)
+    filename = os.path.basename(filepath)[:-4]
+    entry = {
+        "filepath": filepath,
+        "filename": filename,
+        "filetype": file_type(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "status": ParState.OK,
+        "segments": 0,
+        "rows": 0,
+        "tags": {},
+    }
+    content = ParTagIndex(filepath)
+    if len(content) == 0:
+        entry["status"] = ParState.FAIL
+        return entry
+
+    for name, (start, end) in content.offsets.items():
+        if name != "Segment1" and end - start <= HEADER_TAG_SIZE:
+            entry["tags"].update(header_values(name, content[name]))
+    if "Segment1" not in content:
+        entry["status"] = ParState.DATAEMPTY
+        return entry
+
+    values, entry["rows"], entry["segments"] = segment_structure(content)
+    entry["tags"].update(values)
+    if entry["rows"] == 0:
+        entry["status"] = ParState.DATAEMPTY
+    return entry
+
+def select_entries(entries, filetypes=None, pattern=None, min_segments=None, tags=None):
+    # readable entries matching every given filter, in ParManager.sort order.
+    # pattern : glob on the filename, tags : {"Tag.Key" : glob on its value}, both case insensitive
+    selected = []
+    for entry in entries:
+        if entry["status"] != ParState.OK:
+            continue
+        if filetypes is not None and entry["filetype"] not in filetypes:
+            continue
+        if pattern is not None and not fnmatch.fnmatchcase(entry["filename"].lower(), pattern.lower()):
+            continue
+        if min_segments is not None and entry["segments"] < min_segments:
+            continue
+        if tags is not None and not all(key in entry["tags"] and fnmatch.fnmatchcase(entry["tags"][key].lower(), value.lower()) for key, value in tags.items()):
+            continue
+        selected.append(entry)
+    return sorted(selected, key=lambda entry: file_order(entry["filename"], entry["filetype"]))
+
+class ParCatalog:
+    # Entries (file type, segment and row counts, header tag values, size, mtime) of every .par file under root,
+    # kept as a json index in indexdir. update() rescans only the files whose size or mtime changed,
+    # so selecting and filtering a campaign never parses sample data. indexdir None : not persisted.
+    def __init__(self, root, indexdir=None):
+        self.root = os.path.abspath(root)
+        self.indexpath = None
+        self.entries = {}
+        self.dirty = False
+        if indexdir is not None:
+            key = hashlib.sha1(self.root.encode('utf-8')).hexdigest()
+            self.indexpath = os.path.join(indexdir, f"catalog_{key}.json")
+            try:
+                with open(self.indexpath, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+                if index["version"] == CATALOG_VERSION and index["root"] == self.root:
+                    self.entries = index["entries"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def update(self, progress=None, cancel=None):
+        # progress(done, total) after every rescanned file, cancel : threading.Event ; returns the files rescanned
+        found = dict(walk_files(self.root))
+        for filepath in [filepath for filepath in self.entries if filepath not in found]:
+            del self.entries[filepath]
+            self.dirty = True
+
+        changed = []
+        for filepath, stat in found.items():
+            entry = self.entries.get(filepath)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+                changed.append((filepath, stat))
+        for done, (filepath, stat) in enumerate(changed, 1):
+            if cancel is not None and cancel.is_set():
+                break
+            try:
+                self.entries[filepath] = scan_file(filepath, stat)
+            except OSError:
+                # removed or unreadable since the walk
+                self.entries.pop(filepath, None)
+            self.dirty = True
+            if progress is not None:
+                progress(done, len(changed))
+        return len(changed)
+
+    def select(self, filetypes=None, pattern=None, min_segments=None, tags=None):
+        return select_entries(self.entries.values(), filetypes, pattern, min_segments, tags)
+
+    def save(self):
+        if self.indexpath is None or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.indexpath), exist_ok=True)
+        temppath = f"{self.indexpath[:-5]}.{os.getpid()}.tmp"
+        with open(temppath, 'w', encoding='utf-8') as f:
+            json.dump({"version": CATALOG_VERSION, "root": self.root, "entries": self.entries}, f)
+        os.replace(temppath, self.indexpath)
+        self.dirty = False
@@ -0,0 +1,150 @@
+import os
+import sys
+import glob
+import time
+import datetime
+import argparse
+import importlib.util
+from functools import partial
+
+from parreader import ParState
+from parmanager import ParManager, ParMergeType, load_reader
+from parcache import ParCache, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE
+from parmanifest import MANIFEST_NAME
+from parcatalog import ParCatalog, FILETYPE_NAMES, scan_file, select_entries
+import parstats
+
+MODES = {
+    "auto": None,
+    "default": ParMergeType.Default,
+    "pbs": ParMergeType.PBS,
+    "voltage": ParMergeType.Voltage,
+}
+
+def find_files(inputs, indexdir=None):
+    # catalog entries of the .par files : directories are searched recursively through a catalog kept in
+    # indexdir (only new or changed files are scanned again), anything else is a path or glob
+    entries = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            catalog = ParCatalog(pattern, indexdir)
+            catalog.update()
+            catalog.save()
+            entries.extend(catalog.entries.values())
+        else:
+            for filepath in glob.glob(pattern, recursive=True) or [pattern]:
+                if os.path.isfile(filepath) and filepath.lower().endswith(".par"):
+                    entries.append(scan_file(os.path.abspath(filepath)))
+    return list({entry["filepath"]: entry for entry in entries}.values())
+
+def export_file(filepath, cache, segment):
+    # per file work done in the workers, only the summary travels back
+    par = load_reader(filepath, cache, analyse=True)
+    if par.status != ParState.OK:
+        return par
+    par.select_segment = segment
+    par.unload()
+    return par
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch export of .par files without the GUI")
+    parser.add_argument("inputs", nargs="+", help="directories, .par files or glob patterns")
+    parser.add_argument("-o", "--output", help="output directory (default : a new timestamp directory)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default : all cores)")
+    parser.add_argument("-d", "--detail", action="store_true", help="also save per segment and per file figures")
+    parser.add_argument("-m", "--mode", choices=MODES, default="auto", help="merge mode (default : from the file names)")
+    parser.add_argument("-s", "--segment", type=int, default=2, help="segment used for the user option outputs")
+    parser.add_argument("-f", "--format", choices=("auto", "csv", "parquet", "arrow"), default="auto",
+                        help="table format of the data and peak outputs (default : parquet when pyarrow is installed, else csv). "
+                             "parquet / arrow stream one file at a time ; the wide csv tables hold the chosen segment of every file in memory")
+    parser.add_argument("--type", action="append", choices=FILETYPE_NAMES.values(), help="only files of this name type (repeatable)")
+    parser.add_argument("--name", help="only files whose name matches this glob")
+    parser.add_argument("--min-segments", type=int, default=None, help="only files with at least this many segments")
+    parser.add_argument("--tag", action="append", default=[], metavar="KEY=VALUE", help="only files whose header tag KEY (e.g. Experiment.Name) matches the glob VALUE (repeatable)")
+    parser.add_argument("--list", action="store_true", help="print the selected files from the catalog and exit without parsing them")
+    parser.add_argument("--previous", help="earlier export, outputs whose inputs did not change are linked from it (default : the output directory when it holds one)")
+    parser.add_argument("--stats", nargs="?", const="time", choices=("time", "memory"),
+                        help="time every stage (memory : also peak allocations, slower), print a summary and write stats.json / trace.json to the output")
+    parser.add_argument("--memory-budget", type=int, default=None, help="MB of sample data kept loaded while exporting (default : one file at a time)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_DIR, help="parse cache directory")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="parse cache size limit in bytes")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the parse cache")
+    args = parser.parse_args(argv)
+
+    if args.format == "auto":
+        args.format = "parquet" if importlib.util.find_spec("pyarrow") is not None else "csv"
+    if args.format != "csv":
+        try:
+            import parexport
+        except ImportError:
+            print(f"pyarrow is required for --format {args.format}", file=sys.stderr)
+            return 1
+
+    tags = dict(tag.partition("=")[::2] for tag in args.tag)
+    filetypes = None if args.type is None else {filetype for filetype, name in FILETYPE_NAMES.items() if name in args.type}
+    entries = select_entries(find_files(args.inputs, None if args.no_cache else args.cache), filetypes, args.name, args.min_segments, tags or None)
+    if args.list:
+        for entry in entries:
+            print(f"{entry['filepath']}\t{FILETYPE_NAMES[entry['filetype']]}\t{entry['segments']} segments\t{entry['rows']} rows")
+        return 0
+    # files without the --segment segment can not go into the user option tables
+    skipped = 0
+    for entry in entries:
+        if entry["segments"] <= args.segment:
+            print(f"skipping {entry['filepath']} : {entry['segments']} segments, no segment {args.segment}", file=sys.stderr)
+            skipped += 1
+    filepaths = [entry["filepath"] for entry in entries if entry["segments"] > args.segment]
+    if len(filepaths) == 0:
+        print("No files", file=sys.stderr)
+        return 1
+
+    savepath = args.output or datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    os.makedirs(savepath, exist_ok=True)
+    previous = args.previous
+    if previous is None and os.path.exists(os.path.join(savepath, MANIFEST_NAME)):
+        previous = savepath
+
+    cache = None if args.no_cache else ParCache(args.cache, args.cache_size)
+    memory_budget = None if args.memory_budget is None else args.memory_budget << 20
+    manager = ParManager(workers=args.workers, cache=cache, resident=False, memory_budget=memory_budget)
+
+    if args.stats:
+        parstats.enable(memory=args.stats == "memory")
+    start = time.perf_counter()
+    rows = 0
+    loader = partial(export_file, cache=cache, segment=args.segment)
+    for done, par in enumerate(manager.iter_load(filepaths, loader=loader), 1):
+        if par.status == ParState.OK and par.max_segment <= args.segment:
+            # the catalog counts rows the reader skips by status, a last segment can vanish
+            print(f"\nskipping {par.filepath} : {par.max_segment} segments, no segment {args.segment}", file=sys.stderr)
+            skipped += 1
+            continue
+        manager.add(par)
+        if par.status == ParState.OK:
+            rows += int(par.segmentOffsets[-1])
+        print(f"\r{done} / {len(filepaths)}", end="", file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+    if skipped:
+        print(f"{skipped} files skipped without segment {args.segment}", file=sys.stderr)
+    manager.finish_load()
+
+    if len(manager.files) == 0:
+        print("No readable .par files", file=sys.stderr)
+        return 1
+
+    mode = MODES[args.mode]
+    manager.save(savepath, detail=args.detail, mode=manager.type if mode is None else mode, fmt=args.format, previous=previous)
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(manager.files)} files, {rows} rows in {elapsed:.2f} s : "
+          f"{len(manager.files) / elapsed:.1f} files/s, {rows / elapsed:.0f} rows/s -> {savepath}")
+    
+    stats = parstats.disable()
+    if stats is not None:
+        stats.save_json(os.path.join(savepath, "stats.json"))
+        stats.save_chrome_trace(os.path.join(savepath, "trace.json"))
+        print(stats.report())
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
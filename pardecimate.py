@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from paranalysis import segmented_argmin, segmented_argmax
+
+# buckets per drawn trace, more than the pixel width of the widest figure (15 in at 100 dpi)
+DECIMATE_BUCKETS = 2000
+# bytes of decimated traces kept, at most 64 KB per trace with the default buckets
+TRACE_CACHE_BYTES = 64 << 20
+
+def decimate(voltages, currents, buckets=DECIMATE_BUCKETS):
+    # min / max current of every bucket of consecutive samples, in sample order : at most 2 x buckets points,
+    # the drawn line keeps its envelope and peaks. Copies, never views into the sample buffers.
+    n = len(currents)
+    if n <= 2 * buckets:
+        return voltages.copy(), currents.copy()
+    bounds = np.linspace(0, n, buckets + 1).astype(np.int64)
+    starts, stops = bounds[:-1], bounds[1:]
+    keep = np.unique(np.concatenate([segmented_argmin(currents, starts, stops), segmented_argmax(currents, starts, stops), [0, n - 1]]))
+    return voltages[keep], currents[keep]
+
+# part -> (voltage view, current view) of a reader
+PARTS = {
+    "segment": lambda par: (par.voltages, par.currents),
+    "firstHalf": lambda par: (par.firstHalfVoltagesAll, par.firstHalfCurrentsAll),
+    "secondHalf": lambda par: (par.secondHalfVoltagesAll, par.secondHalfCurrentsAll),
+}
+
+class ParTraceCache:
+    # decimated traces per (file, segment, part), least recently used ones dropped past max_bytes ;
+    # an entry is recomputed when its segment changed length. Used from the GUI and save threads.
+    def __init__(self, max_bytes=TRACE_CACHE_BYTES, buckets=DECIMATE_BUCKETS):
+        self.max_bytes = max_bytes
+        self.buckets = buckets
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def trace(self, par, segment, part="segment"):
+        key = (par.filepath, segment, part)
+        length = int(par.segmentOffsets[segment + 1] - par.segmentOffsets[segment])
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == length:
+                self.entries.move_to_end(key)
+                return entry[1], entry[2]
+
+        voltages, currents = PARTS[part](par)
+        voltages, currents = decimate(voltages[segment], currents[segment], self.buckets)
+        with self.lock:
+            self.drop(key)
+            self.entries[key] = (length, voltages, currents)
+            self.nbytes += voltages.nbytes + currents.nbytes
+            while self.nbytes > self.max_bytes and len(self.entries) > 1:
+                self.drop(next(iter(self.entries)))
+        return voltages, currents
+
+    def drop(self, key):
+        # caller holds the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes + entry[2].nbytes
+
+    def discard(self, filepath):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == filepath]:
+                self.drop(key)
+
+_traces = None
+
+def get_trace_cache():
+    # one cache per process, shared by the saved figures and the GUI preview
+    global _traces
+    if _traces is None:
+        _traces = ParTraceCache()
+    return _traces
@@ -0,0 +1,64 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FORMATS = {
+    "parquet": "parquet",
+    "arrow": "arrow",
+}
+
+# long format : one row per sample
+TRACE_SCHEMA = pa.schema([
+    ("file", pa.string()),
+    ("segment", pa.int32()),
+    ("index", pa.int32()),
+    ("voltage", pa.float64()),
+    ("current", pa.float64()),
+])
+
+class ParTableWriter:
+    # Parquet or Arrow IPC file written one record batch at a time
+    def __init__(self, path, schema, fmt="parquet"):
+        self.schema = schema
+        if fmt == "parquet":
+            self.sink = None
+            self.writer = pq.ParquetWriter(path, schema)
+        elif fmt == "arrow":
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, schema)
+        else:
+            raise ValueError(f"Unknown format {fmt}")
+
+    def write(self, columns):
+        self.writer.write_batch(pa.record_batch(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ParTraceWriter(ParTableWriter):
+    def __init__(self, path, fmt="parquet"):
+        super().__init__(path, TRACE_SCHEMA, fmt)
+
+    def write_trace(self, filename, segment, voltages, currents):
+        count = len(voltages)
+        self.write({
+            "file": pa.repeat(filename, count),
+            "segment": np.full(count, segment, dtype=np.int32),
+            "index": np.arange(count, dtype=np.int32),
+            "voltage": voltages,
+            "current": currents,
+        })
+
+def write_table(path, columns, fmt="parquet"):
+    # small tables (peaks) in a single batch
+    table = pa.table(columns)
+    with ParTableWriter(path, table.schema, fmt) as writer:
+        writer.writer.write_table(table)
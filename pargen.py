@@ -0,0 +1,100 @@
+import os
+import argparse
+
+import numpy as np
+
+HEADER = """<Application>
+Name=VersaStudio
+Version=2.60
+</Application>
+<Instrument>
+Model=PMC-1000
+Serial=SYNTHETIC
+</Instrument>
+<Experiment>
+Name=Cyclic Voltammetry
+Scan Rate (V/s)={scanrate}
+</Experiment>
+"""
+
+SEGMENT_HEADER = [
+    "Definition=Segment 1",
+    "Label=Cyclic Voltammetry (Multiple Cycles)",
+    "Segment #,Point #,E(V),I(A),Elapsed Time(s),ADC Sync Input(V),Current Range,Status,E Applied(V),Current Range (A)",
+    "Units=,,V,A,s,V,,,V,A",
+]
+
+# status values that check_status keeps, and ones it skips (bits 8/9/10/16/17/18, low nibble 0b1111)
+KEEP_STATUS = np.array([0, 1, 2, 4, 7, 1 << 11, 1 << 12])
+SKIP_STATUS = np.array([1 << 8, 1 << 9, 1 << 10, 1 << 16, 1 << 17, 1 << 18, 0b1111, 0b11111])
+
+def cv_segment(rows, rng, high=0.8, low=-0.8, e0=0.05, peak=3e-6, capacitance=2e-6, noise=2e-8):
+    # one CV cycle : sweep down from high to low and back, reduction peak on the way down,
+    # oxidation peak on the way back, plus a capacitive offset and noise
+    half = rows // 2
+    down = np.linspace(high, low, half, endpoint=False)
+    up = np.linspace(low, high, rows - half)
+    voltages = np.concatenate([down, up])
+
+    width = 0.04 + 0.01 * rng.random()
+    cathodic = -peak * np.exp(-((down - (e0 - 0.03)) / width) ** 2)
+    anodic = peak * np.exp(-((up - (e0 + 0.03)) / width) ** 2)
+    currents = np.concatenate([cathodic - capacitance, anodic + capacitance])
+    currents += 1e-6 * voltages + rng.normal(0, noise, rows)
+    return voltages, currents
+
+def write_par(filepath, segments=4, rows=2000, seed=0, skip_fraction=0.02, scanrate=0.05):
+    # rows : samples per segment, skip_fraction : share of rows with a status check_status rejects
+    rng = np.random.default_rng(seed)
+    with open(filepath, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(HEADER.format(scanrate=scanrate))
+        f.write("<Segment1>\n")
+        f.write("\n".join(SEGMENT_HEADER))
+        f.write("\n")
+
+        point = 0
+        for segment in range(segments):
+            voltages, currents = cv_segment(rows, rng, peak=(2 + rng.random()) * 1e-6)
+            points = np.arange(point, point + rows)
+            point += rows
+            times = points * (0.002 / scanrate)
+            status = rng.choice(KEEP_STATUS, rows)
+            skip = rng.random(rows) < skip_fraction
+            status[skip] = rng.choice(SKIP_STATUS, skip.sum())
+            currentRange = np.full(rows, 1e-4)
+
+            block = np.column_stack([np.full(rows, segment), points, voltages, currents, times,
+                                     np.zeros(rows), np.full(rows, 4), status, voltages, currentRange])
+            np.savetxt(f, block, delimiter=",", fmt=["%d", "%d", "%.7e", "%.7e", "%.4f", "%.1f", "%d", "%d", "%.7e", "%.1e"])
+
+        f.write("</Segment1>\n")
+        f.write("<Comments>\nSynthetic data\n</Comments>\n")
+
+def write_campaign(directory, count, segments=4, rows=2000, seed=0):
+    # GLUCOSE (concentration), PBS and voltage named files, like a real experiment folder
+    os.makedirs(directory, exist_ok=True)
+    filepaths = []
+    for i in range(count):
+        if i % 10 == 0:
+            filename = f"PBS{i // 10 + 1}.par"
+        elif i % 10 == 9:
+            filename = f"{100 * (i // 10 + 1)}V.par"
+        else:
+            filename = f"{i * 10}.par"
+        filepath = os.path.join(directory, filename)
+        write_par(filepath, segments, rows, seed + i)
+        filepaths.append(filepath)
+    return filepaths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic .par files")
+    parser.add_argument("output", help="output directory")
+    parser.add_argument("-n", "--count", type=int, default=10, help="number of files")
+    parser.add_argument("--segments", type=int, default=4, help="segments per file")
+    parser.add_argument("--rows", type=int, default=2000, help="rows per segment")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    write_campaign(args.output, args.count, args.segments, args.rows, args.seed)
+
+if __name__ == "__main__":
+    main()
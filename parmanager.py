@@ -1,48 +1,138 @@
 import os
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')
+import numpy as np
 
-from parreader import ParReader, ParState, ParFileNameType
+from parreader import ParReader, ParState, ParFileNameType, file_order
+from parstats import timed, remote, received
+from pardecimate import get_trace_cache
+from parmatrix import ParMatrix, column_stats, baseline_difference, concentration_fit
+
+HALF_NAMES = ("FirstHalf", "SecondHalf")
+
+# GUI sessions keep up to this many bytes of sample data loaded
+DEFAULT_MEMORY_BUDGET = 1 << 30
 
 class ParMergeType:
     Default = 0
     PBS = 1
     Voltage = 2
 
+def load_reader(filepath, cache=None, analyse=False):
+    # parse one file, runs inside the worker processes. analyse : also find the peaks of every segment
+    # (batch exports need them all), otherwise they are found on first use
+    if cache is not None:
+        par = cache.load(filepath)
+        if par is not None:
+            if analyse and any(peaks is None for peaks in par._peaks):
+                par.analysis_all()
+                cache.store(par)
+            return par
+    
+    par = ParReader(filepath, cache)
+    if par.status == ParState.OK:
+        if analyse:
+            par.analysis_all()
+        if cache is not None:
+            cache.store(par)
+    return par
+
+def describe_files(self, *args, **kwargs):
+    return None, sum(par.row_count() for par in self.files.values())
+
 class ParManager:
-    def __init__(self):
+    def __init__(self, workers=None, cache=None, resident=True, memory_budget=None):
         self.files = OrderedDict()
         self.type = ParMergeType.Default
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        # resident=False : files keep only their summary and are reloaded one at a time when exporting
+        self.resident = resident
+        # memory_budget : bytes of sample data kept loaded, the least recently used files are unloaded
+        # past it (resident=False is a budget of 0). Summaries (peaks, segment counts, file type) always stay.
+        if memory_budget is None and not resident:
+            memory_budget = 0
+        self.memory_budget = memory_budget
+        self.loaded = OrderedDict()
+        self.loaded_bytes = 0
+        # voltage aligned traces of the files, resampled once per file and segment
+        self.matrix = ParMatrix()
+    
+    def iter_load(self, filepaths, workers=None, loader=None):
+        # ParReaders in the order of filepaths, parsed in a process pool with a bounded number in flight.
+        # loader(filepath) -> ParReader must be picklable, load_reader by default
+        loader = loader or partial(load_reader, cache=self.cache)
+        workers = min(workers or self.workers, len(filepaths))
+        if workers <= 1:
+            for filepath in filepaths:
+                yield loader(filepath)
+            return
+        
+        # stage records of the workers are merged into the stats of this process
+        loader = remote(loader)
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            try:
+                for filepath in filepaths:
+                    pending.append(executor.submit(loader, filepath))
+                    if len(pending) >= workers * 2:
+                        yield received(pending.popleft().result())
+                while pending:
+                    yield received(pending.popleft().result())
+            finally:
+                for future in pending:
+                    future.cancel()
+    
+    def load(self, filepaths, workers=None):
+        for par in self.iter_load(filepaths, workers):
+            self.add(par)
+        self.finish_load()
+    
+    def finish_load(self):
+        self.sort()
+        if self.cache is not None:
+            self.cache.evict()
         
     def add(self, par : ParReader):
         if par.status == ParState.OK:
+            self.matrix.discard(par.filepath)
+            get_trace_cache().discard(par.filepath)
             self.files[par.filepath] = par
+            self.release(par)
             if par.filetype == ParFileNameType.PBS:
                 self.type = ParMergeType.PBS if self.type == ParMergeType.Default else ParMergeType.Default
             elif par.filetype == ParFileNameType.VOLTAGE:
                 self.type = ParMergeType.Voltage if self.type == ParMergeType.Default else ParMergeType.Default            
     
     def sort(self):
-        
-        def filesort(items):
-            par = items[1]
-            if par.filetype == ParFileNameType.PBS:
-                value = int(par.filename[3:])
-                return value - 200000
-            if par.filetype == ParFileNameType.GLUCOSE:
-                return int(par.filename)
-            if par.filetype == ParFileNameType.VOLTAGE:
-                return int(par.filename[:-1])
-    
-        self.files = OrderedDict(sorted(self.files.items(), key=filesort))
+        self.files = OrderedDict(sorted(self.files.items(), key=lambda items: file_order(items[1].filename, items[1].filetype)))
 
     
     def remove(self, filepath):
         self.files.pop(filepath)
+        self.matrix.discard(filepath)
+        get_trace_cache().discard(filepath)
+        self.loaded_bytes -= self.loaded.pop(filepath, 0)
+    
+    def release(self, par):
+        # called once a file is no longer in use, it becomes the most recently used one
+        if self.memory_budget is None:
+            return
+        self.loaded_bytes -= self.loaded.pop(par.filepath, 0)
+        if par.is_loaded():
+            self.loaded[par.filepath] = par.nbytes()
+            self.loaded_bytes += self.loaded[par.filepath]
+        self.evict()
+    
+    def evict(self):
+        while self.loaded_bytes > self.memory_budget:
+            filepath, nbytes = self.loaded.popitem(last=False)
+            self.loaded_bytes -= nbytes
+            par = self.files.get(filepath)
+            if par is not None:
+                par.unload()
     
     def get_min_segment(self):
         min_segment = None
@@ -53,20 +143,106 @@ class ParManager:
                 min_segment = file.max_segment
         return min_segment
     
-    def save_user_figure(self, savepath):
-        plt.figure(figsize=(15, 10))
+    @timed("save_user_figure", describe_files)
+    def save_user_figure(self, savepath, fmt="csv"):
+        self.save_traces(savepath, "Segment_User_Option", lambda file: file.select_segment, fmt, figsize=(15, 10))
+    
+    @timed("save_traces", describe_files)
+    def save_traces(self, savepath, name, segment_of, fmt="csv", figsize=None):
+        # overlay figure, and the traces either as a wide csv (one column pair per file, so the chosen
+        # segment of every file is held until the table is written) or as a long table streamed
+        # to Parquet / Arrow one file at a time
+        from parrender import get_renderer
         data = {}
+        traces = []
+        writer = None
+        if fmt == "csv":
+            import pandas as pd
+        else:
+            from parexport import ParTraceWriter, FORMATS
+            writer = ParTraceWriter(os.path.join(savepath, f"{name}_data.{FORMATS[fmt]}"), fmt)
+        
+        # the overlay draws decimated traces, only the tables get every sample
+        renderer = get_renderer()
         for file in self.files.values():
-            data[file.filename] = pd.Series(file.voltages[file.select_segment])        
-            data[f"{file.filename}_segment#{file.select_segment}"] = pd.Series(file.currents[file.select_segment])
-            plt.plot(file.voltages[file.select_segment], file.currents[file.select_segment], label=f"{file.filename}")
-        plt.legend()
-        plt.savefig(os.path.join(savepath, f"Segment_User_Option.png"))
-        plt.close()
-        df = pd.DataFrame(data)
-        df.to_csv(os.path.join(savepath, F"Segment_User_Option_data.csv"), index=False)
-    
-    def save_user_csv(self, savepath):
+            segment = segment_of(file)
+            voltages = file.voltages[segment]
+            currents = file.currents[segment]
+            if writer is None:
+                data[file.filename] = pd.Series(voltages.copy())        
+                data[f"{file.filename}_segment#{segment}"] = pd.Series(currents.copy())
+            else:
+                writer.write_trace(file.filename, segment, voltages, currents)
+            traces.append((f"{file.filename}", *renderer.traces.trace(file, segment)))
+            self.release(file)
+        renderer.render_overlay(traces, os.path.join(savepath, f"{name}.png"), figsize=figsize)
+        
+        if writer is None:
+            df = pd.DataFrame(data)
+            df.to_csv(os.path.join(savepath, f"{name}_data.csv"), index=False)
+        else:
+            writer.close()
+    
+    @timed("save_peaks", lambda self, savepath, name, data, fmt="csv": (None, len(data["Filename"])))
+    def save_peaks(self, savepath, name, data, fmt="csv"):
+        self.save_table(savepath, name, data, fmt)
+    
+    def save_table(self, savepath, name, data, fmt="csv"):
+        if fmt == "csv":
+            import pandas as pd
+            df = pd.DataFrame(data)
+            df.to_csv(os.path.join(savepath, f"{name}.csv"), index=False)
+        else:
+            from parexport import write_table, FORMATS
+            write_table(os.path.join(savepath, f"{name}.{FORMATS[fmt]}"), data, fmt)
+    
+    def fit_tafel(self, segments=None):
+        # filepath -> TafelFit of every segment (or of the given ones), one file loaded at a time
+        results = OrderedDict()
+        for file in self.files.values():
+            fileSegments = range(file.max_segment) if segments is None else [segment for segment in segments if segment < file.max_segment]
+            results[file.filepath] = [file.tafel(segment) for segment in fileSegments]
+            self.release(file)
+        return results
+    
+    @timed("save_tafel_csv", describe_files)
+    def save_tafel_csv(self, savepath, fmt="csv"):
+        # Tafel slopes are in V / decade
+        data = {
+            "Filename" : [],
+            "Segment#" : [],
+            "cathodic_tafel_slope" : [],
+            "cathodic_r2" : [],
+            "cathodic_voltage_start" : [],
+            "cathodic_voltage_end" : [],
+            "anodic_tafel_slope" : [],
+            "anodic_r2" : [],
+            "anodic_voltage_start" : [],
+            "anodic_voltage_end" : [],
+            "corrosion_potential" : [],
+            "corrosion_current" : [],
+        }
+        for file, fits in zip(self.files.values(), self.fit_tafel().values()):
+            for segment, fit in enumerate(fits):
+                data["Filename"].append(file.filename)
+                data["Segment#"].append(segment)
+                for branch, line in (("cathodic", fit.cathodic), ("anodic", fit.anodic)):
+                    fitted = line.start != -1
+                    data[f"{branch}_tafel_slope"].append(1 / line.slope if fitted and line.slope != 0 else None)
+                    data[f"{branch}_r2"].append(line.r2 if fitted else None)
+                    data[f"{branch}_voltage_start"].append(line.estart if fitted else None)
+                    data[f"{branch}_voltage_end"].append(line.estop if fitted else None)
+                data["corrosion_potential"].append(None if np.isnan(fit.ecorr) else fit.ecorr)
+                data["corrosion_current"].append(None if np.isnan(fit.icorr) else fit.icorr)
+        self.save_table(savepath, "Tafel", data, fmt)
+    
+    def segment_matrix(self, segment_of, half=0, files=None):
+        # grid voltages and a files x grid current matrix of segment_of(file) for every file (default : all)
+        files = list(self.files.values()) if files is None else files
+        return self.matrix.matrix(files, [segment_of(file) for file in files], half, self.release)
+    
+    @timed("save_user_csv", describe_files)
+    def save_user_csv(self, savepath, fmt="csv"):
         filename = []
         segment_num = []
         minpeak_voltage = []
@@ -80,32 +256,24 @@ class ParManager:
             minpeak_current.append(None if file.peaksAll[file.select_segment][0][0] == -1 else file.peaksAll[file.select_segment][0][2])
             maxpeak_voltage.append(None if file.peaksAll[file.select_segment][1][0] == -1 else file.peaksAll[file.select_segment][1][1])
             maxpeak_current.append(None if file.peaksAll[file.select_segment][1][0] == -1 else file.peaksAll[file.select_segment][1][2])
+            # peaks not found yet load the file
+            self.release(file)
         data = {
-            "Filename" : pd.Series(filename),
-            "Segment#" : pd.Series(segment_num),
-            "cathodicpeak_voltage" : pd.Series(minpeak_voltage),
-            "cathodicpeak_current" : pd.Series(minpeak_current),
-            "anodicpeak_voltage" : pd.Series(maxpeak_voltage),
-            "anodicpeak_current" : pd.Series(maxpeak_current)
+            "Filename" : filename,
+            "Segment#" : segment_num,
+            "cathodicpeak_voltage" : minpeak_voltage,
+            "cathodicpeak_current" : minpeak_current,
+            "anodicpeak_voltage" : maxpeak_voltage,
+            "anodicpeak_current" : maxpeak_current
         }
-        
-        df = pd.DataFrame(data)
-        df.to_csv(os.path.join(savepath, F"Segment_User_Option_Peak.csv"), index=False)
+        self.save_peaks(savepath, "Segment_User_Option_Peak", data, fmt)
     
-    def save_segment_figure(self, savepath, segment):
-        plt.figure()
-        data = {}
-        for file in self.files.values():
-            data[file.filename] = pd.Series(file.voltages[segment])
-            data[f"{file.filename}_segment#{segment}"] = pd.Series(file.currents[segment])
-            plt.plot(file.voltages[segment], file.currents[segment], label=f"{file.filename}")
-        plt.legend()
-        plt.savefig(os.path.join(savepath, f"Segment{segment}.png"))
-        plt.close()
-        df = pd.DataFrame(data)
-        df.to_csv(os.path.join(savepath, F"Segment{segment}_data.csv"), index=False)
-    
-    def save_segment_csv(self, savepath, segment):
+    @timed("save_segment_figure", describe_files)
+    def save_segment_figure(self, savepath, segment, fmt="csv"):
+        self.save_traces(savepath, f"Segment{segment}", lambda file: segment, fmt)
+    
+    @timed("save_segment_csv", describe_files)
+    def save_segment_csv(self, savepath, segment, fmt="csv"):
         filename = []
         segment_num = []
         minpeak_voltage = []
@@ -119,52 +287,126 @@ class ParManager:
             minpeak_current.append(None if file.peaksAll[segment][0][0] == -1 else file.peaksAll[segment][0][2])
             maxpeak_voltage.append(None if file.peaksAll[segment][1][0] == -1 else file.peaksAll[segment][1][1])
             maxpeak_current.append(None if file.peaksAll[segment][1][0] == -1 else file.peaksAll[segment][1][2])
+            # peaks not found yet load the file
+            self.release(file)
         data = {
-            "Filename" : pd.Series(filename),
-            "Segment#" : pd.Series(segment_num),
-            "cathodic_peak_voltage" : pd.Series(minpeak_voltage),
-            "cathodic_current" : pd.Series(minpeak_current),
-            "anodic_voltage" : pd.Series(maxpeak_voltage),
-            "anodic_current" : pd.Series(maxpeak_current)
+            "Filename" : filename,
+            "Segment#" : segment_num,
+            "cathodic_peak_voltage" : minpeak_voltage,
+            "cathodic_current" : minpeak_current,
+            "anodic_voltage" : maxpeak_voltage,
+            "anodic_current" : maxpeak_current
         }
-        df = pd.DataFrame(data)
-        df.to_csv(os.path.join(savepath, F"Segment{segment}_Peak.csv"), index=False)
+        self.save_peaks(savepath, f"Segment{segment}_Peak", data, fmt)
     
     
-    def save(self, savepath, check, mode):
+    @timed("save_all", describe_files)
+    def save(self, savepath, detail=False, mode=ParMergeType.Default, progress=None, cancel=None, fmt="csv", previous=None):
+        # progress(done, total) after every step, cancel : threading.Event checked between steps.
+        # fmt : "csv" (wide, one column pair per file) or "parquet" / "arrow" (long tables)
+        # previous : directory of an earlier export, output groups whose inputs did not change are linked from it
         if len(self.files) == 0:
             print("No files")
             return
-
-        mode = mode.get()
-
-        saveDetail = check[0].get()
         
+        from parrender import RENDER_VERSION
+        from parmanifest import ParManifest
         min_segment = self.get_min_segment()
-            
-        ### User options
-        self.save_user_figure(savepath)
-        self.save_user_csv(savepath)
+        total = 1 + (min_segment if detail else 0) + (len(self.files) if detail else 0)
+        
+        def report(done):
+            if progress is not None:
+                progress(done, total)
+        
+        manifest = ParManifest(savepath, previous)
+        files = list(self.files.values())
+        names = [file.filename for file in files]
+        hashes = [manifest.source_hash(file.filepath) for file in files]
+        selected = [file.select_segment for file in files]
+        try:
+            ### User options
+            manifest.write("user_option", manifest.key("user_option", names, hashes, selected, fmt, RENDER_VERSION),
+                           lambda: (self.save_user_figure(savepath, fmt), self.save_user_csv(savepath, fmt)))
+            report(1)
 
-        if saveDetail:
-            for segment in range(min_segment):
-                self.save_segment_figure(savepath, segment)
-                self.save_segment_csv(savepath, segment)
-                
-            for file in self.files.values():
-                file.save(savepath)
+            if detail:
+                for segment in range(min_segment):
+                    if cancel is not None and cancel.is_set():
+                        return
+                    manifest.write(f"segment_{segment}", manifest.key("segment", segment, names, hashes, fmt, RENDER_VERSION),
+                                   lambda: (self.save_segment_figure(savepath, segment, fmt), self.save_segment_csv(savepath, segment, fmt)))
+                    report(2 + segment)
+            
+            if detail:
+                from parrender import render_files
+                keys = {file.filepath: manifest.key("file", file.filename, filehash, RENDER_VERSION) for file, filehash in zip(files, hashes)}
+                stale = [file for file in files if not manifest.reuse(f"file:{file.filepath}", keys[file.filepath])]
+                for file in stale:
+                    manifest.clear(f"file:{file.filepath}")
+                reused = len(files) - len(stale)
+                report(total - len(files) + reused)
+                render_files(stale, savepath, self.workers, lambda done, _: report(total - len(files) + reused + done), cancel, self.release)
+                if cancel is not None and cancel.is_set():
+                    return
+                for file in stale:
+                    manifest.record(f"file:{file.filepath}", keys[file.filepath], [file.filename])
+            
+            if mode == ParMergeType.PBS:
+                manifest.write("mode_pbs", manifest.key("pbs", names, hashes, selected, fmt, RENDER_VERSION),
+                               lambda: self.save_pbs_type(savepath, fmt))
+            if mode == ParMergeType.Voltage:
+                manifest.write("mode_voltage", manifest.key("voltage", names, hashes, selected, fmt, RENDER_VERSION),
+                               lambda: (self.save_voltage_type(savepath, fmt), self.save_tafel_csv(savepath, fmt)))
+        finally:
+            manifest.save()
+    
+    @timed("save_pbs_type", describe_files)
+    def save_pbs_type(self, savepath, fmt="csv"):
+        # user option segment of every file minus the mean PBS trace, per half on the shared voltage grid,
+        # and for the concentration (GLUCOSE) files the linear fit of that difference against the concentration
+        from parrender import get_renderer
+        files = list(self.files.values())
+        pbs = np.array([file.filetype == ParFileNameType.PBS for file in files], dtype=bool)
+        if not pbs.any() or pbs.all():
+            return
+        samples = [file for file, isPbs in zip(files, pbs) if not isPbs]
+        glucose = np.array([file.filetype == ParFileNameType.GLUCOSE for file in samples], dtype=bool)
+        concentrations = [int(file.filename) for file in samples if file.filetype == ParFileNameType.GLUCOSE]
         
-        if mode == ParMergeType.PBS:
-            self.save_pbs_type(savepath)
-        if mode == ParMergeType.Voltage:
-            self.save_voltage_type(savepath)
-    
-    # TODO:
-    def save_pbs_type(self, savepath):
-        pass
-    
-    # TODO:
-    def save_voltage_type(self, savepath):
-        pass
+        for half, halfName in enumerate(HALF_NAMES):
+            grid, matrix = self.segment_matrix(lambda file: file.select_segment, half, files)
+            difference = baseline_difference(matrix[~pbs], matrix[pbs])
+            
+            data = {"Voltage" : grid}
+            traces = []
+            for file, row in zip(samples, difference):
+                data[f"{file.filename}_segment#{file.select_segment}"] = row
+                traces.append((file.filename, grid, row))
+            self.save_table(savepath, f"PBS_{halfName}_Difference", data, fmt)
+            get_renderer().render_overlay(traces, os.path.join(savepath, f"PBS_{halfName}_Difference.png"))
+            
+            if glucose.sum() >= 2:
+                fit = concentration_fit(concentrations, difference[glucose])
+                self.save_table(savepath, f"PBS_{halfName}_Concentration", {"Voltage" : grid, **fit}, fmt)
+    
+    @timed("save_voltage_type", describe_files)
+    def save_voltage_type(self, savepath, fmt="csv"):
+        # user option segment of every file per half on the shared voltage grid, with the statistics over files
+        from parrender import get_renderer
+        files = list(self.files.values())
+        for half, halfName in enumerate(HALF_NAMES):
+            grid, matrix = self.segment_matrix(lambda file: file.select_segment, half, files)
+            
+            data = {"Voltage" : grid}
+            for file, row in zip(files, matrix):
+                data[f"{file.filename}_segment#{file.select_segment}"] = row
+            self.save_table(savepath, f"Voltage_{halfName}_Matrix", data, fmt)
+            
+            stats = column_stats(matrix)
+            self.save_table(savepath, f"Voltage_{halfName}_Stats", {"Voltage" : grid, **stats}, fmt)
+            traces = [("mean", grid, stats["mean"]),
+                      ("mean - std", grid, stats["mean"] - stats["std"]),
+                      ("mean + std", grid, stats["mean"] + stats["std"])]
+            get_renderer().render_overlay(traces, os.path.join(savepath, f"Voltage_{halfName}_Stats.png"))
         
             
\ No newline at end of file
@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import hashlib
+
+from parcache import file_hash
+
+MANIFEST_NAME = "manifest.json"
+# bump when the tables written by ParManager.save change
+EXPORT_VERSION = 1
+
+def link_tree(source, target):
+    # hard links of a file or directory tree, copies where linking is not possible (other drive, FAT)
+    if os.path.isdir(source):
+        os.makedirs(target, exist_ok=True)
+        for entry in os.scandir(source):
+            link_tree(entry.path, os.path.join(target, entry.name))
+        return
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+def snapshot(savepath):
+    # top level entry -> mtime, to see what one export step wrote
+    return {entry.name: entry.stat().st_mtime_ns for entry in os.scandir(savepath)}
+
+class ParManifest:
+    # Inputs of every output group of an export (source hashes, segments, merge mode, renderer version)
+    # as savepath/manifest.json. Groups whose inputs match the previous export are linked from it
+    # instead of being written again.
+    def __init__(self, savepath, previous=None):
+        self.savepath = savepath
+        self.previous = previous
+        self.outputs = {}
+        self.sources = {}
+        self.previousOutputs = {}
+        self.previousSources = {}
+        if previous is not None:
+            try:
+                with open(os.path.join(previous, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                if manifest["version"] == EXPORT_VERSION:
+                    self.previousOutputs = manifest["outputs"]
+                    self.previousSources = manifest["sources"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def source_hash(self, filepath):
+        # content hash of a source file, taken from the previous manifest while size and mtime match
+        filepath = os.path.abspath(filepath)
+        if filepath not in self.sources:
+            stat = os.stat(filepath)
+            known = self.previousSources.get(filepath)
+            if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+                self.sources[filepath] = known
+            else:
+                self.sources[filepath] = [stat.st_size, stat.st_mtime_ns, file_hash(filepath)]
+        return self.sources[filepath][2]
+
+    def key(self, *inputs):
+        return hashlib.sha1(json.dumps([EXPORT_VERSION, *inputs]).encode('utf-8')).hexdigest()
+
+    def reuse(self, name, key):
+        # True when the previous export wrote group name from the same inputs ; its outputs are linked here
+        entry = self.previousOutputs.get(name)
+        if entry is None or entry["key"] != key:
+            return False
+        sources = [os.path.join(self.previous, output) for output in entry["outputs"]]
+        if not all(os.path.exists(source) for source in sources):
+            return False
+        if os.path.abspath(self.previous) != os.path.abspath(self.savepath):
+            for output, source in zip(entry["outputs"], sources):
+                link_tree(source, os.path.join(self.savepath, output))
+        self.outputs[name] = entry
+        return True
+
+    def clear(self, name):
+        # exporting again into the previous directory : drop the old outputs of a group before rewriting it,
+        # they may be hard links shared with older exports
+        entry = self.previousOutputs.get(name)
+        if entry is None or os.path.abspath(self.previous) != os.path.abspath(self.savepath):
+            return
+        for output in entry["outputs"]:
+            path = os.path.join(self.savepath, output)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def record(self, name, key, outputs):
+        self.outputs[name] = {"key": key, "outputs": sorted(outputs)}
+
+    def write(self, name, key, writer):
+        # run writer() unless the group can be reused, its outputs are the top level entries it touched
+        if self.reuse(name, key):
+            return False
+        self.clear(name)
+        before = snapshot(self.savepath)
+        writer()
+        after = snapshot(self.savepath)
+        self.record(name, key, [output for output, mtime in after.items() if before.get(output) != mtime and output != MANIFEST_NAME])
+        return True
+
+    def save(self):
+        manifest = {"version": EXPORT_VERSION, "sources": self.sources, "outputs": self.outputs}
+        temppath = os.path.join(self.savepath, f"{MANIFEST_NAME}.tmp")
+        with open(temppath, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temppath, os.path.join(self.savepath, MANIFEST_NAME))
+
+def latest_export(root="."):
+    # most recent export directory under root holding a manifest, None without one
+    exports = []
+    for entry in os.scandir(root):
+        manifestpath = os.path.join(entry.path, MANIFEST_NAME)
+        if entry.is_dir() and os.path.exists(manifestpath):
+            exports.append((os.path.getmtime(manifestpath), entry.path))
+    return max(exports)[1] if exports else None
@@ -0,0 +1,103 @@
+import warnings
+
+import numpy as np
+
+# grid voltages are multiples of GRID_STEP volts, so traces of different voltage windows line up
+GRID_STEP = 0.001
+
+def resample(voltages, currents, step=GRID_STEP):
+    # one sweep onto the grid : (index of the first grid voltage, currents at the grid voltages it covers)
+    if len(voltages) < 2:
+        return 0, np.empty(0)
+    order = np.argsort(voltages, kind="stable")
+    voltages = voltages[order]
+    currents = currents[order]
+    start = int(np.ceil(voltages[0] / step - 1e-9))
+    stop = int(np.floor(voltages[-1] / step + 1e-9)) + 1
+    if stop <= start:
+        return start, np.empty(0)
+    return start, np.interp(np.arange(start, stop) * step, voltages, currents)
+
+class ParMatrix:
+    # files x voltage matrices of one segment half (0 : first, 1 : second).
+    # Every (file, segment) is resampled once and kept until the file is discarded or the segment changes length,
+    # the last matrix of each half is reused while the same traces are asked for.
+    def __init__(self, step=GRID_STEP):
+        self.step = step
+        self.rows = {}
+        self.matrices = {}
+
+    def row(self, par, segment):
+        length = int(par.segmentOffsets[segment + 1] - par.segmentOffsets[segment])
+        rows = self.rows.setdefault(par.filepath, {})
+        if segment not in rows or rows[segment][0] != length:
+            first = resample(par.firstHalfVoltagesAll[segment], par.firstHalfCurrentsAll[segment], self.step)
+            second = resample(par.secondHalfVoltagesAll[segment], par.secondHalfCurrentsAll[segment], self.step)
+            rows[segment] = (length, first, second)
+        return rows[segment][1:]
+
+    def discard(self, filepath):
+        # the file changed or left : its rows and any matrix built from them
+        self.rows.pop(filepath, None)
+        for half in [half for half, cached in self.matrices.items() if any(key[0] == filepath for key in cached[0])]:
+            del self.matrices[half]
+
+    def matrix(self, pars, segments, half=0, release=None):
+        # grid voltages and a len(pars) x len(grid) matrix, NaN outside the voltage range of each trace ;
+        # release(par) after a file has been resampled
+        rows = []
+        for par, segment in zip(pars, segments):
+            rows.append(self.row(par, segment)[half])
+            if release is not None:
+                release(par)
+
+        key = tuple((par.filepath, segment, start, len(values)) for par, segment, (start, values) in zip(pars, segments, rows))
+        cached = self.matrices.get(half)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+
+        covered = [(start, start + len(values)) for start, values in rows if len(values) > 0]
+        low = min((start for start, _ in covered), default=0)
+        high = max((stop for _, stop in covered), default=0)
+        matrix = np.full((len(rows), high - low), np.nan)
+        for i, (start, values) in enumerate(rows):
+            matrix[i, start - low:start - low + len(values)] = values
+        grid = np.arange(low, high) * self.step
+
+        self.matrices[half] = (key, grid, matrix)
+        return grid, matrix
+
+def column_stats(matrix):
+    # mean, std, min, max over files at every grid voltage, NaN where no file covers it
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return {
+            "mean": np.nanmean(matrix, axis=0),
+            "std": np.nanstd(matrix, axis=0),
+            "min": np.nanmin(matrix, axis=0),
+            "max": np.nanmax(matrix, axis=0),
+        }
+
+def baseline_difference(matrix, baseline):
+    # rows minus the mean of the baseline (PBS) rows
+    return matrix - column_stats(baseline)["mean"]
+
+def concentration_fit(concentrations, matrix):
+    # least squares current = slope * concentration + intercept at every grid voltage,
+    # files without data at a voltage are left out of its fit
+    valid = ~np.isnan(matrix)
+    x = np.where(valid, np.asarray(concentrations, dtype=float)[:, None], 0.0)
+    y = np.where(valid, matrix, 0.0)
+    n = valid.sum(axis=0)
+    sx, sy = x.sum(axis=0), y.sum(axis=0)
+    sxx, sxy, syy = (x * x).sum(axis=0), (x * y).sum(axis=0), (y * y).sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = n * sxx - sx * sx
+        dy = n * syy - sy * sy
+        slope = (n * sxy - sx * sy) / dx
+        intercept = (sy - slope * sx) / n
+        r2 = (n * sxy - sx * sy) ** 2 / (dx * dy)
+    unfit = (n < 2) | (dx <= 0)
+    slope[unfit] = intercept[unfit] = r2[unfit] = np.nan
+    return {"slope": slope, "intercept": intercept, "r2": r2}
@@ -1,11 +1,12 @@
 import os
 import datetime
-import math
-import re
 
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.signal import find_peaks
+
+from partags import ParTagIndex
+from parsegments import SegmentView, SegmentList
+from parstats import timed
+from paranalysis import split_halves, log_scale_currents, split_tafel, find_segment_peaks, fit_segment_tafel, encode_peaks, decode_peaks
 
 class ParState:
     OK = 0
@@ -20,6 +21,38 @@ class ParFileNameType:
     VOLTAGE = 3
     
 
+# Segment1 columns used : Segment #, E(V), I(A), Status
+SEGMENT_COLUMNS = (0, 2, 3, 7)
+
+# Rows with any of these status bits set are skipped (bits 8, 9, 10, 16, 17, 18)
+STATUS_SKIP_BITS = (1 << 8) | (1 << 9) | (1 << 10) | (1 << 16) | (1 << 17) | (1 << 18)
+STATUS_SKIP_NIBBLE = 0b1111
+
+def file_type(filename):
+    # PBS5, 300V, 10 (glucose concentration) ; filename without the .par extension
+    if "PBS" in filename:
+        return ParFileNameType.PBS
+    if "V" in filename:
+        return ParFileNameType.VOLTAGE
+    try:
+        int(filename)
+        return ParFileNameType.GLUCOSE
+    except ValueError:
+        return ParFileNameType.NONE
+
+def file_order(filename, filetype):
+    # sort key : PBS files first, then by the number in the name ; unnumbered names last, by name
+    try:
+        if filetype == ParFileNameType.PBS:
+            return (0, int(filename[3:]) - 200000)
+        if filetype == ParFileNameType.GLUCOSE:
+            return (0, int(filename))
+        if filetype == ParFileNameType.VOLTAGE:
+            return (0, int(filename[:-1]))
+    except ValueError:
+        pass
+    return (1, filename)
+
 # TODO:
 class ParMode:
     CV = 0
@@ -27,219 +60,291 @@ class ParMode:
 #
 
 class ParReader:
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache=None):
+        self.cache = cache
         if os.path.basename(filepath)[-3:].lower() != "par":
             self.status = ParState.NOPAR
             return    
         
         self.filepath = filepath
         self.filename = os.path.basename(filepath)[:-4]
-        if "PBS" in self.filename:
-            self.filetype = ParFileNameType.PBS
-        elif "V" in self.filename:
-            self.filetype = ParFileNameType.VOLTAGE
-        else:
-            try:
-                int(self.filename)
-                self.filetype = ParFileNameType.GLUCOSE
-            except:
-                self.filetype = ParFileNameType.NONE
+        self.filetype = file_type(self.filename)
         
         self.read_data(filepath)
         if self.status == ParState.OK:
-            self.analysis_all()
+            self.invalidate()
         self.select_segment = 2
         
+    @timed("read_data", lambda self, filepath: (os.path.basename(filepath), self.row_count()))
     def read_data(self, filepath):
 
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = f.read()
-        if data is None:
-            self.status = ParState.FAIL
-            return
-        
-        pattern = r"<(\w+)>\s*(.*?)\s*</\1>"
-        matches = re.findall(pattern, data, re.DOTALL)
-        self.content = {match[0]: match[1].strip() for match in matches}
+        self.content = ParTagIndex(filepath)
         if len(self.content) == 0:
             self.status = ParState.FAIL
             return
         
-        segmentData = self.content.get("Segment1").split("\n")
-        
-        if segmentData is None or len(segmentData) < 4:
+        if "Segment1" not in self.content:
             self.status = ParState.DATAEMPTY
             return
-                    
-        segments = []
-        voltages = []
-        currents = []
-        
-        for data in segmentData[4:]:
-            splitdata = data.split(",")
-            status = int(splitdata[7])
-            skip = self.check_status(status)
-            if skip: continue
-            
-            segment = int(splitdata[0])
-            voltage = float(splitdata[2])
-            current = float(splitdata[3])
-            
-            segments.append(segment)
-            voltages.append(voltage)
-            currents.append(current)
-        
-        self.max_segment = max(segments) + 1
-
-        counts = []
-        for s in range(self.max_segment):
-            counts.append(segments.count(s))
-        
-        self.voltages = [[] for _ in range(self.max_segment)]
-        self.currents = [[] for _ in range(self.max_segment)]
-    
-        i = 0
-        for s in range(self.max_segment):
-            self.voltages[s] = voltages[i:counts[s] + i]
-            self.currents[s] = currents[i:counts[s] + i]
-            i += counts[s]
-            
-        self.status = ParState.OK
-    
-    def analysis_all(self):
-        
-        self.firstHalfVoltagesAll = [[] for _ in range(self.max_segment)]
-        self.firstHalfCurrentsAll = [[] for _ in range(self.max_segment)]
-        self.secondHalfVoltagesAll = [[] for _ in range(self.max_segment)]
-        self.secondHalfCurrentsAll = [[] for _ in range(self.max_segment)]
-        self.logScaleCurrentsAll = [[] for _ in range(self.max_segment)]
-        self.cathodicVoltagesAll = [[] for _ in range(self.max_segment)]
-        self.cathodicCurrentsAll = [[] for _ in range(self.max_segment)]
-        self.anodicVoltagesAll = [[] for _ in range(self.max_segment)]
-        self.anodicCurrentsAll = [[] for _ in range(self.max_segment)]
-        self.peaksAll = [[] for _ in range(self.max_segment)]
         
-        for segment in range(self.max_segment):
-            self.analysis(segment)
+        # 4 header lines, then comma separated rows
+        segmentData = self.content.open("Segment1", skip_lines=4)
+        if len(segmentData.getbuffer()) == segmentData.tell():
+            self.status = ParState.DATAEMPTY
+            return
         
-    def analysis(self, segment):
+        ## Columnar parse (segment, voltage, current, status)
+        columns = np.loadtxt(segmentData, delimiter=",", usecols=SEGMENT_COLUMNS, ndmin=2, encoding="utf-8")
         
-        voltages = self.voltages[segment]
-        currents = self.currents[segment]
+        status = columns[:, 3].astype(np.int64)
+        keep = ~self.check_status_mask(status)
         
-        ## Get voltage min max
-        voltageMaxIdx = voltages.index(max(voltages))
-        voltageMinIdx = voltages.index(min(voltages))
+        segments = columns[keep, 0].astype(np.int64)
+        voltages = columns[keep, 1]
+        currents = columns[keep, 2]
         
-        ## Split half
-        firstHalfVoltages = self.firstHalfVoltagesAll[segment]
-        firstHalfCurrents = self.firstHalfCurrentsAll[segment]
-        secondHalfVoltages = self.secondHalfVoltagesAll[segment]
-        secondHalfCurrents = self.secondHalfCurrentsAll[segment]
-
-        if voltageMaxIdx < voltageMinIdx:
-            firstHalfVoltages.extend(voltages[voltageMaxIdx:voltageMinIdx])
-            firstHalfCurrents.extend(currents[voltageMaxIdx:voltageMinIdx])
-            secondHalfVoltages.extend(voltages[voltageMinIdx:])
-            secondHalfCurrents.extend(currents[voltageMinIdx:])
-        else:
-            firstHalfVoltages.extend(voltages[:voltageMinIdx])
-            firstHalfCurrents.extend(currents[:voltageMinIdx])
-            secondHalfVoltages.extend(voltages[voltageMinIdx:voltageMaxIdx])
-            secondHalfCurrents.extend(currents[voltageMinIdx:voltageMaxIdx])
+        if len(segments) == 0:
+            self.status = ParState.DATAEMPTY
+            return
         
+        self.max_segment = int(segments.max()) + 1
         
-        ## Get peaks
-        peaks = self.peaksAll[segment]
+        counts = np.bincount(segments, minlength=self.max_segment)
+        offsets = np.zeros(self.max_segment + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
         
-        if len(firstHalfCurrents) == 0:
-            peaks.append((-1, -1, -1))
-        else:
-            firstpeaks, _ = find_peaks(-np.float32(firstHalfCurrents), width=10)
-            if len(firstpeaks) == 0:
-                peaks.append((-1, -1, -1))
-            else:
-                peaks.append((firstpeaks[0], firstHalfVoltages[firstpeaks[0]], firstHalfCurrents[firstpeaks[0]]))
+        # one contiguous buffer per channel, segment s is [offsets[s], offsets[s + 1])
+        self.voltageData = np.ascontiguousarray(voltages)
+        self.currentData = np.ascontiguousarray(currents)
+        self.segmentOffsets = offsets
             
-        if len(secondHalfCurrents) == 0:
-            peaks.append((-1, -1, -1))
+        self.status = ParState.OK
+    
+    ## Sample buffers, dropped by unload() and read back on first use
+    @property
+    def voltageData(self):
+        if self._voltageData is None:
+            self.reload()
+        return self._voltageData
+    
+    @voltageData.setter
+    def voltageData(self, data):
+        self._voltageData = data
+    
+    @property
+    def currentData(self):
+        if self._currentData is None:
+            self.reload()
+        return self._currentData
+    
+    @currentData.setter
+    def currentData(self, data):
+        self._currentData = data
+    
+    def row_count(self):
+        return int(self.segmentOffsets[-1]) if self.status == ParState.OK else 0
+    
+    def is_loaded(self):
+        return self._voltageData is not None
+    
+    def nbytes(self):
+        # resident size of the sample buffers and analysis results
+        if not self.is_loaded():
+            return 0
+        total = self._voltageData.nbytes + self._currentData.nbytes
+        if self._logScaleCurrentData is not None:
+            total += self._logScaleCurrentData.nbytes
+        return total
+    
+    def unload(self):
+        # keep the summary (peaks found so far, segment offsets, file type), drop samples and derived data
+        if not self.is_loaded():
+            return
+        self._voltageData = None
+        self._currentData = None
+        self._logScaleCurrentData = None
+        self._analysed[:] = False
+    
+    def reload(self):
+        par = self.cache.load(self.filepath) if self.cache is not None else None
+        if par is None:
+            segmentOffsets = self.segmentOffsets
+            self.read_data(self.filepath)
+            if self.status != ParState.OK:
+                raise ValueError(f"{self.filepath} can not be reloaded")
+            if not np.array_equal(segmentOffsets, self.segmentOffsets):
+                # the source changed since it was first read
+                self.invalidate()
         else:
-            secondpeaks, _ = find_peaks(np.float32(secondHalfCurrents), width=10)
-            if len(secondpeaks) == 0:
-                peaks.append((-1, -1, -1))
-            else:
-                peaks.append((secondpeaks[0], secondHalfVoltages[secondpeaks[0]], secondHalfCurrents[secondpeaks[0]]))
-                
-        ## Logscale (only second half)
-        logScaleCurrent = self.logScaleCurrentsAll[segment]
-        if len(secondHalfCurrents) == 0:
+            self._voltageData = par.voltageData
+            self._currentData = par.currentData
+            if not np.array_equal(self.segmentOffsets, par.segmentOffsets):
+                self.max_segment = par.max_segment
+                self.segmentOffsets = par.segmentOffsets
+                self.invalidate()
+    
+    @property
+    def voltages(self):
+        return SegmentView.from_offsets(self.voltageData, self.segmentOffsets)
+    
+    @property
+    def currents(self):
+        return SegmentView.from_offsets(self.currentData, self.segmentOffsets)
+    
+    ## Analysis products are index ranges into voltageData / currentData / logScaleCurrentData,
+    ## computed on first access and kept until invalidate()
+    @property
+    def firstHalfRanges(self):
+        self.update_analysis()
+        return self._firstHalfRanges
+    
+    @property
+    def secondHalfRanges(self):
+        self.update_analysis()
+        return self._secondHalfRanges
+    
+    @property
+    def cathodicRanges(self):
+        self.update_analysis()
+        return self._cathodicRanges
+    
+    @property
+    def anodicRanges(self):
+        self.update_analysis()
+        return self._anodicRanges
+    
+    @property
+    def logScaleCurrentData(self):
+        self.update_analysis()
+        return self._logScaleCurrentData
+    
+    @property
+    def firstHalfVoltagesAll(self):
+        return SegmentView.from_ranges(self.voltageData, self.firstHalfRanges)
+    
+    @property
+    def firstHalfCurrentsAll(self):
+        return SegmentView.from_ranges(self.currentData, self.firstHalfRanges)
+    
+    @property
+    def secondHalfVoltagesAll(self):
+        return SegmentView.from_ranges(self.voltageData, self.secondHalfRanges)
+    
+    @property
+    def secondHalfCurrentsAll(self):
+        return SegmentView.from_ranges(self.currentData, self.secondHalfRanges)
+    
+    @property
+    def logScaleCurrentsAll(self):
+        return SegmentView.from_ranges(self.logScaleCurrentData, self.secondHalfRanges)
+    
+    @property
+    def cathodicVoltagesAll(self):
+        return SegmentView.from_ranges(self.voltageData, self.cathodicRanges)
+    
+    @property
+    def cathodicCurrentsAll(self):
+        return SegmentView.from_ranges(self.logScaleCurrentData, self.cathodicRanges)
+    
+    @property
+    def anodicVoltagesAll(self):
+        return SegmentView.from_ranges(self.voltageData, self.anodicRanges)
+    
+    @property
+    def anodicCurrentsAll(self):
+        return SegmentView.from_ranges(self.logScaleCurrentData, self.anodicRanges)
+    
+    @property
+    def peaksAll(self):
+        return SegmentList(self.peaks, self.max_segment)
+    
+    def invalidate(self, segment=None):
+        # forget analysis results, of one segment or of all of them
+        if segment is None:
+            self._peaks = [None] * self.max_segment
+            self._tafel = [None] * self.max_segment
+            self.reset_ranges()
+        else:
+            self._analysed[segment] = False
+            self._peaks[segment] = None
+            self._tafel[segment] = None
+    
+    def reset_ranges(self):
+        self._analysed = np.zeros(self.max_segment, dtype=bool)
+        self._firstHalfRanges = np.zeros((self.max_segment, 2), dtype=np.int64)
+        self._secondHalfRanges = np.zeros((self.max_segment, 2), dtype=np.int64)
+        self._cathodicRanges = np.zeros((self.max_segment, 2), dtype=np.int64)
+        self._anodicRanges = np.zeros((self.max_segment, 2), dtype=np.int64)
+        self._logScaleCurrentData = None
+    
+    def update_analysis(self):
+        
+        segments = np.flatnonzero(~self._analysed)
+        if len(segments) == 0:
             return
         
-        logScaleCurrent.extend(list(map(lambda x : math.log10(abs(x * (10**3))), secondHalfCurrents)))
+        starts = self.segmentOffsets[segments]
+        stops = self.segmentOffsets[segments + 1]
         
-        ## Split cathodic anodic
-        # get min max idx
-        tafelMinCurrentIdx = logScaleCurrent.index(min(logScaleCurrent))
-        tafelMaxCurrentIdx = logScaleCurrent.index(max(logScaleCurrent))
+        ## Split half, log scale current and cathodic / anodic for every pending segment at once
+        firstHalfRanges, secondHalfRanges = split_halves(self.voltageData, starts, stops)
+        if self._logScaleCurrentData is None:
+            self._logScaleCurrentData = log_scale_currents(self.currentData)
+        else:
+            for start, stop in zip(starts, stops):
+                self._logScaleCurrentData[start:stop] = log_scale_currents(self.currentData[start:stop])
+        cathodicRanges, anodicRanges = split_tafel(self._logScaleCurrentData, secondHalfRanges)
         
-        # cathodic
-        cathodicVoltages = self.cathodicVoltagesAll[segment]
-        cathodicCurrents = self.cathodicCurrentsAll[segment]
-        # anodic
-        anodicVoltages = self.anodicVoltagesAll[segment]
-        anodicCurrents = self.anodicCurrentsAll[segment]
+        self._firstHalfRanges[segments] = firstHalfRanges
+        self._secondHalfRanges[segments] = secondHalfRanges
+        self._cathodicRanges[segments] = cathodicRanges
+        self._anodicRanges[segments] = anodicRanges
+        self._analysed[segments] = True
+    
+    def peaks(self, segment):
         
-        cathodicVoltages.extend(secondHalfVoltages[:tafelMinCurrentIdx])
-        cathodicCurrents.extend(logScaleCurrent[:tafelMinCurrentIdx])
-        anodicVoltages.extend(secondHalfVoltages[tafelMinCurrentIdx:tafelMaxCurrentIdx])
-        anodicCurrents.extend(logScaleCurrent[tafelMinCurrentIdx:tafelMaxCurrentIdx])
+        if self._peaks[segment] is None:
+            self._peaks[segment] = find_segment_peaks(self.voltageData, self.currentData, self.firstHalfRanges[segment], self.secondHalfRanges[segment])
+        return self._peaks[segment]
     
-    def save(self, savepath):
-        dirpath = os.path.join(savepath, self.filename)
-        os.makedirs(dirpath, exist_ok=True)
+    def tafel(self, segment):
+        # TafelFit of the cathodic / anodic branches, computed on first use
+        if self._tafel[segment] is None:
+            self._tafel[segment] = fit_segment_tafel(self.voltageData, self.logScaleCurrentData, self.cathodicRanges[segment], self.anodicRanges[segment])
+        return self._tafel[segment]
+    
+    def __getstate__(self):
+        # buffers and the peak table pickle as flat arrays, ranges and log current are cheap to rebuild
+        state = self.__dict__.copy()
+        for name in ("_analysed", "_firstHalfRanges", "_secondHalfRanges", "_cathodicRanges", "_anodicRanges", "_logScaleCurrentData"):
+            state.pop(name, None)
+        if "_peaks" in state:
+            state["_peaks"] = encode_peaks(self._peaks)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "_peaks" in state:
+            self._peaks = decode_peaks(state["_peaks"])
+            if "_tafel" not in state:
+                self._tafel = [None] * self.max_segment
+            self.reset_ranges()
+    
+    def analysis_all(self):
         
         for segment in range(self.max_segment):
-            segmentpath = os.path.join(dirpath, f"segement_{segment}")
-            os.makedirs(segmentpath, exist_ok=True)
-            
-            plt.figure()
-            plt.title(f"{self.filename}, Segment # {segment}", fontsize=10, fontweight='bold')
-            plt.plot(self.voltages[segment], self.currents[segment])
-            plt.savefig(os.path.join(segmentpath, f"Segement_{segment}.png"))
-            plt.close()
-            
-            plt.figure()
-            plt.title(f"{self.filename}, Segment # {segment}, Split Half", fontsize=10, fontweight='bold')
-            plt.plot(self.firstHalfVoltagesAll[segment], self.firstHalfCurrentsAll[segment], color='b')
-            plt.plot(self.secondHalfVoltagesAll[segment], self.secondHalfCurrentsAll[segment], color='r')
-            plt.savefig(os.path.join(segmentpath, f"Segment_{segment}_splithalf.png"))
-            plt.close()
-            
-            plt.figure()
-            plt.title(f"{self.filename}, Segment # {segment}, Peaks", fontsize=10, fontweight='bold')
-            if self.peaksAll[segment][0][0] != -1:
-                plt.scatter(self.peaksAll[segment][0][1], self.peaksAll[segment][0][2], s=40, color='b', label=f"V : {self.peaksAll[segment][0][1]}, I : {self.peaksAll[segment][0][2]}")
-            if self.peaksAll[segment][1][0] != -1:
-                plt.scatter(self.peaksAll[segment][1][1], self.peaksAll[segment][1][2], s=40, color='r', label=f"V : {self.peaksAll[segment][1][1]}, I : {self.peaksAll[segment][1][2]}")
-            plt.plot(self.firstHalfVoltagesAll[segment], self.firstHalfCurrentsAll[segment], color='b')
-            plt.plot(self.secondHalfVoltagesAll[segment], self.secondHalfCurrentsAll[segment], color='r')
-            if self.peaksAll[segment][0][0] != -1 or self.peaksAll[segment][1][0] != -1:
-                plt.legend()
-            plt.savefig(os.path.join(segmentpath, f"Segment_{segment}_peaks.png"))
-            plt.close()
+            self.analysis(segment)
         
-            plt.figure()
-            plt.title(f"{self.filename}, Segment # {segment}, log scale current", fontsize=10, fontweight='bold')
-            plt.scatter(self.secondHalfVoltagesAll[segment], self.logScaleCurrentsAll[segment], marker='s', s=5, color='b')
-            plt.savefig(os.path.join(segmentpath, f"Segement_{segment}_log.png"))
-            plt.close()
+    @timed("analysis", lambda self, segment: (self.filename, int(self.segmentOffsets[segment + 1] - self.segmentOffsets[segment])))
+    def analysis(self, segment):
         
-            plt.figure()
-            plt.title(f"{self.filename}, Segment # {segment}, Tafel", fontsize=10, fontweight='bold')
-            plt.scatter(self.cathodicVoltagesAll[segment], self.cathodicCurrentsAll[segment], s=5, color='b')
-            plt.scatter(self.anodicVoltagesAll[segment], self.anodicCurrentsAll[segment], s=5, color='r')
-            plt.savefig(os.path.join(segmentpath, f"Segment_{segment}_tafel.png"))
-            plt.close()
+        self.update_analysis()
+        self.peaks(segment)
+    
+    @timed("save", lambda self, savepath: (self.filename, self.row_count()))
+    def save(self, savepath):
+        from parrender import get_renderer
+        get_renderer().render_file(self, savepath)
     
     def check_status(self, status):
         
@@ -252,6 +357,10 @@ class ParReader:
         if (status & 0b1111) == 0b1111: return True
         
         return False
+    
+    def check_status_mask(self, status):
+        
+        return ((status & STATUS_SKIP_BITS) != 0) | ((status & STATUS_SKIP_NIBBLE) == STATUS_SKIP_NIBBLE)
         
             
             
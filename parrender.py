@@ -0,0 +1,141 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from parstats import timed, remote, received
+from pardecimate import get_trace_cache
+
+# bump when the look of the saved figures changes
+RENDER_VERSION = 2
+
+class ParRenderer:
+    # Agg figures without pyplot, one reusable figure / axes per figure size ;
+    # line plots draw decimated traces (pardecimate), scatter plots every sample
+    def __init__(self):
+        self.templates = {}
+        self.traces = get_trace_cache()
+
+    def axes(self, title=None, figsize=None):
+        if figsize not in self.templates:
+            figure = Figure(figsize=figsize)
+            FigureCanvasAgg(figure)
+            self.templates[figsize] = (figure, figure.add_subplot())
+        figure, axes = self.templates[figsize]
+        axes.clear()
+        if title is not None:
+            axes.set_title(title, fontsize=10, fontweight='bold')
+        return axes
+
+    @timed("savefig")
+    def savefig(self, axes, path):
+        axes.figure.savefig(path)
+
+    def render_overlay(self, traces, path, figsize=None):
+        # traces : (label, voltages, currents)
+        axes = self.axes(figsize=figsize)
+        for label, voltages, currents in traces:
+            axes.plot(voltages, currents, label=label)
+        axes.legend()
+        self.savefig(axes, path)
+
+    @timed("render_file", lambda self, par, savepath: (par.filename, par.row_count()))
+    def render_file(self, par, savepath):
+        dirpath = os.path.join(savepath, par.filename)
+        os.makedirs(dirpath, exist_ok=True)
+
+        for segment in range(par.max_segment):
+            segmentpath = os.path.join(dirpath, f"segement_{segment}")
+            os.makedirs(segmentpath, exist_ok=True)
+            self.render_segment(par, segment, segmentpath)
+
+    def render_segment(self, par, segment, segmentpath):
+        title = f"{par.filename}, Segment # {segment}"
+        firstPeak, secondPeak = par.peaksAll[segment]
+        firstHalf = self.traces.trace(par, segment, "firstHalf")
+        secondHalf = self.traces.trace(par, segment, "secondHalf")
+
+        axes = self.axes(title)
+        axes.plot(*self.traces.trace(par, segment))
+        self.savefig(axes, os.path.join(segmentpath, f"Segement_{segment}.png"))
+
+        axes = self.axes(f"{title}, Split Half")
+        axes.plot(*firstHalf, color='b')
+        axes.plot(*secondHalf, color='r')
+        self.savefig(axes, os.path.join(segmentpath, f"Segment_{segment}_splithalf.png"))
+
+        axes = self.axes(f"{title}, Peaks")
+        if firstPeak[0] != -1:
+            axes.scatter(firstPeak[1], firstPeak[2], s=40, color='b', label=f"V : {firstPeak[1]}, I : {firstPeak[2]}")
+        if secondPeak[0] != -1:
+            axes.scatter(secondPeak[1], secondPeak[2], s=40, color='r', label=f"V : {secondPeak[1]}, I : {secondPeak[2]}")
+        axes.plot(*firstHalf, color='b')
+        axes.plot(*secondHalf, color='r')
+        if firstPeak[0] != -1 or secondPeak[0] != -1:
+            axes.legend()
+        self.savefig(axes, os.path.join(segmentpath, f"Segment_{segment}_peaks.png"))
+
+        axes = self.axes(f"{title}, log scale current")
+        axes.scatter(par.secondHalfVoltagesAll[segment], par.logScaleCurrentsAll[segment], marker='s', s=5, color='b')
+        self.savefig(axes, os.path.join(segmentpath, f"Segement_{segment}_log.png"))
+
+        axes = self.axes(f"{title}, Tafel")
+        axes.scatter(par.cathodicVoltagesAll[segment], par.cathodicCurrentsAll[segment], s=5, color='b')
+        axes.scatter(par.anodicVoltagesAll[segment], par.anodicCurrentsAll[segment], s=5, color='r')
+        self.savefig(axes, os.path.join(segmentpath, f"Segment_{segment}_tafel.png"))
+
+_renderer = None
+
+def get_renderer():
+    # one renderer per process, its figures are reused across calls
+    global _renderer
+    if _renderer is None:
+        _renderer = ParRenderer()
+    return _renderer
+
+def render_file(par, savepath):
+    get_renderer().render_file(par, savepath)
+    return par.filepath
+
+def render_files(pars, savepath, workers=None, progress=None, cancel=None, release=None):
+    # detail figures of every file, one file per task ; progress(done, total) after each file,
+    # files not started yet are skipped once cancel (threading.Event) is set,
+    # release(par) once a file rendered in this process is done with
+    total = len(pars)
+    workers = min(workers or os.cpu_count() or 1, total)
+    if workers <= 1:
+        for done, par in enumerate(pars, 1):
+            if cancel is not None and cancel.is_set():
+                return
+            render_file(par, savepath)
+            if release is not None:
+                release(par)
+            if progress is not None:
+                progress(done, total)
+        return
+
+    # at most 2 x workers readers pickled and queued at a time
+    task = remote(render_file)
+    done = 0
+    pending = set()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for par in pars:
+            if cancel is not None and cancel.is_set():
+                break
+            pending.add(executor.submit(task, par, savepath))
+            if len(pending) < workers * 2:
+                continue
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                received(future.result())
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+        for future in pending:
+            if cancel is not None and cancel.is_set() and future.cancel():
+                continue
+            received(future.result())
+            done += 1
+            if progress is not None:
+                progress(done, total)
@@ -0,0 +1,44 @@
+class SegmentView:
+    # Per segment views data[starts[s]:stops[s]] into one contiguous buffer, no copies
+    def __init__(self, data, starts, stops):
+        self.data = data
+        self.starts = starts
+        self.stops = stops
+
+    @classmethod
+    def from_offsets(cls, data, offsets):
+        return cls(data, offsets[:-1], offsets[1:])
+
+    @classmethod
+    def from_ranges(cls, data, ranges):
+        return cls(data, ranges[:, 0], ranges[:, 1])
+
+    def __getitem__(self, segment):
+        return self.data[self.starts[segment]:self.stops[segment]]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for segment in range(len(self)):
+            yield self[segment]
+
+    def lengths(self):
+        return self.stops - self.starts
+
+
+class SegmentList:
+    # Read only sequence whose items are produced per segment by getter(segment)
+    def __init__(self, getter, length):
+        self.getter = getter
+        self.length = length
+
+    def __getitem__(self, segment):
+        return self.getter(segment)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for segment in range(self.length):
+            yield self.getter(segment)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+from functools import wraps
+
+# Stage timing of the load / analyse / export pipeline. Off by default : a timed() function then costs
+# one global lookup per call. enable() starts recording, disable() stops and returns the ParStats.
+_stats = None
+
+class ParStats:
+    # one record per timed call : stage, file, rows, start / seconds (perf_counter), peak_bytes, pid, tid
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started_tracing = False
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def enter(self):
+        # frames : [traced bytes at start, highest peak of the finished inner stages]
+        frames = getattr(self.local, "frames", None)
+        if frames is None:
+            frames = self.local.frames = []
+        frame = [0, 0]
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if frames:
+                frames[-1][1] = max(frames[-1][1], peak)
+            tracemalloc.reset_peak()
+            frame[0] = current
+        frames.append(frame)
+        return frame
+
+    def leave(self, frame):
+        # peak of a stage is measured above the memory in use when it started ;
+        # the tracemalloc peak is process wide, so stages overlapping in other threads add to it
+        frames = self.local.frames
+        frames.pop()
+        if not self.memory:
+            return 0
+        _, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, frame[1])
+        if frames:
+            frames[-1][1] = max(frames[-1][1], peak)
+        return peak - frame[0]
+
+    def record(self, stage, start, seconds, peak_bytes=0, file=None, rows=None):
+        record = {
+            "stage": stage,
+            "file": file,
+            "rows": rows,
+            "start": start,
+            "seconds": seconds,
+            "peak_bytes": peak_bytes,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        with self.lock:
+            self.records.append(record)
+
+    def merge(self, records):
+        with self.lock:
+            self.records.extend(records)
+
+    def summary(self):
+        # stage -> calls, seconds (total / max), rows, peak_bytes (max)
+        summary = {}
+        for record in self.records:
+            stage = summary.setdefault(record["stage"], {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0, "peak_bytes": 0})
+            stage["calls"] += 1
+            stage["seconds"] += record["seconds"]
+            stage["max_seconds"] = max(stage["max_seconds"], record["seconds"])
+            stage["rows"] += record["rows"] or 0
+            stage["peak_bytes"] = max(stage["peak_bytes"], record["peak_bytes"])
+        return summary
+
+    def per_file(self):
+        # file -> stage -> seconds
+        files = {}
+        for record in self.records:
+            if record["file"] is not None:
+                stages = files.setdefault(record["file"], {})
+                stages[record["stage"]] = stages.get(record["stage"], 0.0) + record["seconds"]
+        return files
+
+    def report(self):
+        lines = [f"{'stage':<22}{'calls':>7}{'total (s)':>11}{'max (s)':>10}{'rows':>12}{'peak (MB)':>11}"]
+        summary = sorted(self.summary().items(), key=lambda item: -item[1]["seconds"])
+        for stage, values in summary:
+            lines.append(f"{stage:<22}{values['calls']:>7}{values['seconds']:>11.3f}{values['max_seconds']:>10.3f}"
+                         f"{values['rows']:>12}{values['peak_bytes'] / (1 << 20):>11.1f}")
+        return "\n".join(lines)
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"summary": self.summary(), "files": self.per_file(), "records": self.records}, f, indent=1)
+
+    def save_chrome_trace(self, path):
+        # complete ("X") events, open with chrome://tracing or Perfetto
+        origin = min((record["start"] for record in self.records), default=0)
+        events = []
+        for record in self.records:
+            events.append({
+                "name": record["stage"],
+                "cat": "par",
+                "ph": "X",
+                "ts": (record["start"] - origin) * 1e6,
+                "dur": record["seconds"] * 1e6,
+                "pid": record["pid"],
+                "tid": record["tid"],
+                "args": {"file": record["file"], "rows": record["rows"], "peak_bytes": record["peak_bytes"]},
+            })
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+def enable(memory=True):
+    # memory=True also measures the peak allocation of every stage with tracemalloc (slower)
+    global _stats
+    if _stats is None:
+        _stats = ParStats(memory)
+        _stats.start()
+    return _stats
+
+def disable():
+    global _stats
+    stats, _stats = _stats, None
+    if stats is not None:
+        stats.stop()
+    return stats
+
+def get_stats():
+    return _stats
+
+def timed(stage, describe=None):
+    # describe(*args, **kwargs) -> (file, rows), evaluated after a successful call
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            stats = _stats
+            if stats is None:
+                return function(*args, **kwargs)
+
+            frame = stats.enter()
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                stats.record(stage, start, time.perf_counter() - start, stats.leave(frame))
+                raise
+            seconds = time.perf_counter() - start
+            peak_bytes = stats.leave(frame)
+            file, rows = describe(*args, **kwargs) if describe is not None else (None, None)
+            stats.record(stage, start, seconds, peak_bytes, file, rows)
+            return result
+        return wrapper
+    return decorate
+
+class _RemoteResult:
+    __slots__ = ("result", "records")
+
+    def __init__(self, result, records):
+        self.result = result
+        self.records = records
+
+class _Remote:
+    # records the stages of one task in a worker process and sends them back with the result
+    def __init__(self, function, memory):
+        self.function = function
+        self.memory = memory
+
+    def __call__(self, *args, **kwargs):
+        global _stats
+        outer, _stats = _stats, ParStats(self.memory)
+        _stats.start()
+        try:
+            result = self.function(*args, **kwargs)
+            return _RemoteResult(result, _stats.records)
+        finally:
+            _stats.stop()
+            _stats = outer
+
+def remote(function):
+    # function to submit to a process pool ; pass the future results through received()
+    if _stats is None:
+        return function
+    return _Remote(function, _stats.memory)
+
+def received(value):
+    if isinstance(value, _RemoteResult):
+        if _stats is not None:
+            _stats.merge(value.records)
+        return value.result
+    return value
@@ -0,0 +1,73 @@
+import os
+import io
+import mmap
+import re
+from collections.abc import Mapping
+
+OPEN_TAG = re.compile(rb"<(\w+)>")
+WHITESPACE = b" \t\n\r\x0b\x0c"
+
+class ParTagIndex(Mapping):
+    # Byte offsets of every <Tag> ... </Tag> body, bodies are only read when asked for
+    def __init__(self, filepath, encoding='utf-8', offsets=None):
+        self.filepath = filepath
+        self.encoding = encoding
+        self.offsets = {}
+        if offsets is None:
+            self.scan()
+        else:
+            self.offsets.update(offsets)
+
+    def scan(self):
+        self.offsets.clear()
+        if os.path.getsize(self.filepath) == 0:
+            return
+
+        with open(self.filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while True:
+                match = OPEN_TAG.search(mm, pos)
+                if match is None:
+                    break
+
+                name = match.group(1)
+                close = mm.find(b"</" + name + b">", match.end())
+                if close < 0:
+                    pos = match.start() + 1
+                    continue
+
+                # strip surrounding whitespace without copying the body
+                start, end = match.end(), close
+                while start < end and mm[start] in WHITESPACE:
+                    start += 1
+                while end > start and mm[end - 1] in WHITESPACE:
+                    end -= 1
+
+                self.offsets[name.decode('ascii')] = (start, end)
+                pos = close + len(name) + 3
+
+    def read(self, name):
+        start, end = self.offsets[name]
+        with open(self.filepath, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def open(self, name, skip_lines=0):
+        stream = io.BytesIO(self.read(name))
+        for _ in range(skip_lines):
+            stream.readline()
+        return stream
+
+    def __getitem__(self, name):
+        # universal newlines, as text mode reads would give
+        text = self.read(name).decode(self.encoding)
+        return text.replace("\r\n", "\n").replace("\r", "\n").strip()
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, name):
+        return name in self.offsets
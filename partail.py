@@ -0,0 +1,177 @@
+import io
+import sys
+import time
+import mmap
+import itertools
+import argparse
+
+import numpy as np
+
+from parreader import ParReader, ParState, SEGMENT_COLUMNS
+from partags import ParTagIndex, WHITESPACE
+from parstats import timed
+
+SEGMENT_OPEN = b"<Segment1>"
+SEGMENT_CLOSE = b"</Segment1>"
+SEGMENT_HEADER_LINES = 4
+
+def grow(buffer, size, needed):
+    # buffer holding at least needed items, the first size ones kept ; capacity doubles
+    if buffer is not None and len(buffer) >= needed:
+        return buffer
+    grown = np.empty(max(needed, 2 * (0 if buffer is None else len(buffer)), 1024), dtype=np.float64)
+    if buffer is not None:
+        grown[:size] = buffer[:size]
+    return grown
+
+class ParTail(ParReader):
+    # ParReader of a .par file still being written. update() parses only the rows appended to the
+    # Segment1 block since the last call, appends them to the sample buffers (amortized doubling) and
+    # invalidates the segments that got rows, so finished segments are never analysed again.
+    def read_data(self, filepath):
+        self.content = ParTagIndex(filepath)
+        self.offset = None
+        self.finished = False
+        self.size = 0
+        self.buffers = {"voltage": None, "current": None, "log": None}
+        self._voltageData = np.empty(0)
+        self._currentData = np.empty(0)
+        self.max_segment = 0
+        self.segmentOffsets = np.zeros(1, dtype=np.int64)
+        self._peaks = []
+        self._tafel = []
+        self.reset_ranges()
+        self.status = ParState.DATAEMPTY
+        self.update()
+
+    def find_rows(self):
+        # byte offset of the first row, None until the Segment1 header is complete
+        with open(self.filepath, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = mm.find(SEGMENT_OPEN)
+                if pos < 0:
+                    return None
+                pos += len(SEGMENT_OPEN)
+                while pos < len(mm) and mm[pos] in WHITESPACE:
+                    pos += 1
+                for _ in range(SEGMENT_HEADER_LINES):
+                    pos = mm.find(b"\n", pos)
+                    if pos < 0:
+                        return None
+                    pos += 1
+                return pos
+
+    @timed("tail_update", lambda self: (self.filename, self.row_count()))
+    def update(self):
+        # parse the rows appended since the last call, returns the segments that changed
+        if self.finished:
+            return []
+        if self.offset is None:
+            self.offset = self.find_rows()
+            if self.offset is None:
+                return []
+
+        with open(self.filepath, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+
+        close = chunk.find(SEGMENT_CLOSE)
+        if close >= 0:
+            chunk = chunk[:close]
+            self.finished = True
+            self.content = ParTagIndex(self.filepath)
+        else:
+            # a partly written last line waits for the next update
+            chunk = chunk[:chunk.rfind(b"\n") + 1]
+        self.offset += len(chunk)
+        if len(chunk.strip()) == 0:
+            return []
+
+        columns = np.loadtxt(io.BytesIO(chunk), delimiter=",", usecols=SEGMENT_COLUMNS, ndmin=2, encoding="utf-8")
+        keep = ~self.check_status_mask(columns[:, 3].astype(np.int64))
+        segments = columns[keep, 0].astype(np.int64)
+        if len(segments) == 0:
+            return []
+        if segments[0] < self.max_segment - 1 or np.any(np.diff(segments) < 0):
+            # rows out of segment order, the buffers can not be appended to
+            self.read_data(self.filepath)
+            return list(range(self.max_segment))
+
+        self.append(segments, columns[keep, 1], columns[keep, 2])
+        return [int(segment) for segment in np.unique(segments)]
+
+    def append(self, segments, voltages, currents):
+        size, needed = self.size, self.size + len(segments)
+        for name, values in (("voltage", voltages), ("current", currents)):
+            self.buffers[name] = grow(self.buffers[name], size, needed)
+            self.buffers[name][size:needed] = values
+        self._voltageData = self.buffers["voltage"][:needed]
+        self._currentData = self.buffers["current"][:needed]
+        log = self._logScaleCurrentData
+        if log is not None:
+            # the appended part is filled by update_analysis, the segments it belongs to are invalidated below
+            buffer = self.buffers["log"] if log.base is self.buffers["log"] else log
+            self.buffers["log"] = grow(buffer, size, needed)
+            self._logScaleCurrentData = self.buffers["log"][:needed]
+        self.size = needed
+
+        max_segment = max(self.max_segment, int(segments[-1]) + 1)
+        counts = np.bincount(segments, minlength=max_segment)
+        counts[:self.max_segment] += np.diff(self.segmentOffsets)
+        offsets = np.zeros(max_segment + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        self.segmentOffsets = offsets
+        self.extend_segments(max_segment)
+
+        for segment in np.unique(segments):
+            self.invalidate(int(segment))
+        self.status = ParState.OK
+
+    def extend_segments(self, max_segment):
+        added = max_segment - self.max_segment
+        if added <= 0:
+            return
+        self._peaks.extend([None] * added)
+        self._tafel.extend([None] * added)
+        self._analysed = np.concatenate([self._analysed, np.zeros(added, dtype=bool)])
+        for name in ("_firstHalfRanges", "_secondHalfRanges", "_cathodicRanges", "_anodicRanges"):
+            setattr(self, name, np.concatenate([getattr(self, name), np.zeros((added, 2), dtype=np.int64)]))
+        self.max_segment = max_segment
+
+    def follow(self, interval=1.0, stop=None):
+        # changed segments after every update that found rows, until the Segment1 block is closed
+        # or stop (threading.Event) is set
+        while not self.finished and (stop is None or not stop.is_set()):
+            segments = self.update()
+            if segments:
+                yield segments
+            elif not self.finished:
+                time.sleep(interval)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print the peaks of a .par file while it is being written")
+    parser.add_argument("filepath")
+    parser.add_argument("-i", "--interval", type=float, default=1.0, help="seconds between checks for new rows")
+    args = parser.parse_args(argv)
+
+    par = ParTail(args.filepath)
+    if par.status == ParState.NOPAR:
+        print(f"{args.filepath} is not a .par file", file=sys.stderr)
+        return 1
+    # segments already written, then the ones that change
+    updates = par.follow(args.interval)
+    if par.status == ParState.OK:
+        updates = itertools.chain([list(range(par.max_segment))], updates)
+    for segments in updates:
+        for segment in segments:
+            start = time.perf_counter()
+            firstPeak, secondPeak = par.peaks(segment)
+            elapsed = time.perf_counter() - start
+            print(f"{par.row_count()} rows, segment {segment} : {par.segmentOffsets[segment + 1] - par.segmentOffsets[segment]} rows, "
+                  f"cathodic {firstPeak[1:]}, anodic {secondPeak[1:]} ({elapsed * 1e3:.1f} ms)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())